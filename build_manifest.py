@@ -0,0 +1,145 @@
+"""
+File: build_manifest.py
+Author: riley cooper
+Email: rwr.cooper@gmail.com
+Description:
+    Build manifest for the pre-processing outputs. For each output file a
+    record is kept of the input files it was built from (size, mtime and
+    content hash) and the parameters of the operation, so a stage can skip
+    outputs that are already up to date and only rebuild the ones affected
+    by new or changed inputs. Inputs are only rehashed when their size or
+    mtime has changed. Records are json files in manifest_path, one per
+    output, so parallel tasks never write the same file.
+"""
+
+
+import hashlib
+import json
+import os
+import journal
+
+
+manifest_path = "data-link/cordex-data/manifest"
+
+
+def file_hash(file, block_size=2**20):
+    '''sha256 of a file's content, read in blocks.'''
+
+    sha = hashlib.sha256()
+    with open(file, "rb") as reader:
+        for block in iter(lambda: reader.read(block_size), b""):
+            sha.update(block)
+
+    return sha.hexdigest()
+
+
+def record_file(outfile):
+    '''path of the manifest record of an output file.'''
+
+    key = hashlib.sha1(os.path.normpath(outfile).encode()).hexdigest()
+    return f"{manifest_path}/{key[:2]}/{key}.json"
+
+
+def read_record(outfile):
+    '''the manifest record of an output file, None if there isn't one.'''
+
+    try:
+        with open(record_file(outfile)) as reader:
+            return json.load(reader)
+    except (OSError, ValueError):
+        return None
+
+
+def file_state(file, old_state=None):
+    '''size, mtime and hash of a file, the hash is reused from old_state if
+    the size and mtime haven't changed.'''
+
+    stat = os.stat(file)
+    state = {"size": stat.st_size, "mtime": stat.st_mtime}
+
+    if (old_state is not None and old_state["size"] == state["size"] and
+            old_state["mtime"] == state["mtime"]):
+        state["hash"] = old_state["hash"]
+    else:
+        state["hash"] = file_hash(file)
+
+    return state
+
+
+def up_to_date(outfile, infiles, params):
+    '''True if outfile exists and was built with params from infiles, none
+    of which have changed since. params None accepts any params, for
+    readers of an output that don't know how it was built.'''
+
+    record = read_record(outfile)
+
+    # compare as stored, e.g. tuples are stored as lists
+    params = json.loads(json.dumps(params))
+
+    if record is None or not os.path.exists(outfile):
+        return False
+
+    if params is not None and record["params"] != params:
+        return False
+
+    if sorted(record["inputs"]) != sorted(infiles):
+        return False
+
+    if os.path.getsize(outfile) != record["output"]["size"]:
+        return False
+
+    touched = False
+
+    for infile in infiles:
+        if not os.path.exists(infile):
+            return False
+
+        old_state = record["inputs"][infile]
+        stat = os.stat(infile)
+
+        if stat.st_size != old_state["size"]:
+            return False
+
+        # touched but not changed files are still up to date, their new
+        # mtime is recorded so they aren't hashed again
+        if stat.st_mtime != old_state["mtime"]:
+            if file_hash(infile) != old_state["hash"]:
+                return False
+            old_state["mtime"] = stat.st_mtime
+            touched = True
+
+    if touched:
+        write_record(outfile, record)
+
+    return True
+
+
+def record_build(outfile, infiles, params):
+    '''records that outfile was built with params from infiles.'''
+
+    old_record = read_record(outfile) or {"inputs": {}}
+
+    stat = os.stat(outfile)
+
+    record = {
+        "output": {"size": stat.st_size, "mtime": stat.st_mtime},
+        "inputs": {
+            infile: file_state(infile, old_record["inputs"].get(infile))
+            for infile in infiles},
+        "params": params,
+    }
+
+    write_record(outfile, record)
+
+
+def write_record(outfile, record):
+    '''saves the manifest record of an output file.'''
+
+    file = record_file(outfile)
+    os.makedirs(os.path.dirname(file), exist_ok=True)
+
+    def write(temp):
+        with open(temp, "w") as writer:
+            json.dump(record, writer, indent=1)
+
+    journal.atomic_write(file, write)
@@ -0,0 +1,253 @@
+"""
+File: catalog.py
+Author: riley cooper
+Email: rwr.cooper@gmail.com
+Description:
+    Catalog of the data tree, so scripts query an index instead of listing
+    the same directories again for every model, city and type. The tree
+    under catalog_root is laid out as
+    <frequency>/<domain>/<var>/<stage>/<driving_model>/<rcm>/<file>, where
+    stage is e.g. historical, rcp85, combined_rcp85, timeseries or slope.
+    The facets of each netcdf file (and zarr store) come from its path and
+    its CORDEX file name: the dataset name before the date range, the start
+    and end years, the yearly type and the city. The catalog is kept in
+    sqlite in catalog_file. A refresh only lists the directories whose
+    mtime has changed since the last refresh.
+"""
+
+
+import os
+import re
+import sqlite3
+
+
+catalog_root = "data-link/cordex-data"
+catalog_file = f"{catalog_root}/catalog/catalog.sqlite"
+
+
+# directories of the tree that aren't data
+skip_dirs = ["catalog", "manifest", "spatial_index", "plots", "journal",
+             "regrid"]
+
+
+path_facets = ["frequency", "domain", "var", "stage", "driving_model", "rcm"]
+name_facets = ["dataset", "type", "city", "start_year", "end_year"]
+
+
+type_pattern = re.compile(r"^year(max|min|mean|sum|gt.+)$")
+dates_pattern = re.compile(r"^(\d{4})\d*-(\d{4})\d*$")
+
+
+schema = f"""
+create table if not exists dirs (
+    path text primary key, parent text, mtime real);
+create index if not exists dirs_parent on dirs (parent);
+create table if not exists files (
+    path text primary key, dir text, name text,
+    {", ".join(f"{facet} text" for facet in path_facets)},
+    dataset text, type text, city text,
+    start_year integer, end_year integer);
+create index if not exists files_dir on files (dir);
+"""
+
+
+# the connection of this process, pool workers open their own
+state = {"connection": None, "pid": None}
+
+
+def connect():
+    '''connection to the catalog, made on first use in each process.'''
+
+    if state["pid"] != os.getpid():
+        os.makedirs(os.path.dirname(catalog_file), exist_ok=True)
+        connection = sqlite3.connect(catalog_file, timeout=60)
+        connection.row_factory = sqlite3.Row
+        connection.executescript(schema)
+        state["connection"] = connection
+        state["pid"] = os.getpid()
+
+    return state["connection"]
+
+
+def parse_path(dir):
+    '''facets of a directory of the tree from its path.'''
+
+    relative = os.path.relpath(dir, catalog_root)
+    parts = [] if relative == "." else relative.split(os.sep)
+
+    return {facet: parts[i] if i < len(parts) else None
+            for i, facet in enumerate(path_facets)}
+
+
+def parse_file_name(stage, name):
+    '''facets of a file of stage from its name, e.g. the dataset name and
+    years of tas_EUR-44_..._v1_mon_195101-195512.nc or the type and city of
+    a timeseries ..._1950-2100_yearmax_ber.nc.'''
+
+    tokens = os.path.splitext(name)[0].split("_")
+
+    facets = {facet: None for facet in name_facets}
+
+    for i, token in enumerate(tokens):
+        dates = dates_pattern.match(token)
+
+        if dates and facets["start_year"] is None:
+            facets["dataset"] = "_".join(tokens[:i])
+            facets["start_year"] = int(dates.group(1))
+            facets["end_year"] = int(dates.group(2))
+
+        elif type_pattern.match(token):
+            facets["type"] = token
+
+            # timeseries are <type>_<city>, their slopes <city>_<type>
+            if stage == "timeseries" and i + 1 < len(tokens):
+                facets["city"] = tokens[i + 1]
+            elif stage == "timeseries_slopes" and i > 0:
+                facets["city"] = tokens[i - 1]
+
+    return facets
+
+
+def file_row(dir, dir_facets, name):
+    '''catalog row of a file.'''
+
+    facets = parse_file_name(dir_facets["stage"], name)
+
+    return ([os.path.join(dir, name), dir, name] +
+            [dir_facets[facet] for facet in path_facets] +
+            [facets[facet] for facet in name_facets])
+
+
+def remove_tree(connection, dir):
+    '''removes a directory and everything under it from the catalog.'''
+
+    prefix = f"{dir}{os.sep}"
+    for table, column in [("files", "dir"), ("dirs", "path")]:
+        connection.execute(
+            f"delete from {table} where {column} = ? or "
+            f"substr({column}, 1, ?) = ?", (dir, len(prefix), prefix))
+
+
+def scan_dir(connection, dir, mtime):
+    '''lists a directory and replaces its entries in the catalog, returns
+    its subdirectories.'''
+
+    dir_facets = parse_path(dir)
+
+    subdirs = []
+    rows = []
+    with os.scandir(dir) as entries:
+        for entry in entries:
+            if entry.name.startswith("."):
+                continue
+
+            if entry.name.endswith(".zarr") or entry.name.endswith(".nc"):
+                rows.append(file_row(dir, dir_facets, entry.name))
+            elif entry.is_dir() and entry.name not in skip_dirs:
+                subdirs.append(entry.path)
+
+    columns = 3 + len(path_facets) + len(name_facets)
+
+    connection.execute("delete from files where dir = ?", (dir,))
+    connection.executemany(
+        f"insert into files values ({', '.join(['?'] * columns)})", rows)
+
+    old_subdirs = connection.execute(
+        "select path from dirs where parent = ?", (dir,)).fetchall()
+    for (old_subdir,) in old_subdirs:
+        if old_subdir not in subdirs:
+            remove_tree(connection, old_subdir)
+
+    connection.execute(
+        "insert or replace into dirs values (?, ?, ?)",
+        (dir, os.path.dirname(dir), mtime))
+
+    return subdirs
+
+
+def refresh(root=catalog_root):
+    '''brings the catalog of root up to date, only listing the directories
+    whose mtime has changed since they were last listed.'''
+
+    connection = connect()
+
+    todo = [os.path.normpath(root)]
+    listed = 0
+
+    with connection:
+        while todo:
+            dir = todo.pop()
+
+            try:
+                mtime = os.stat(dir).st_mtime
+            except FileNotFoundError:
+                remove_tree(connection, dir)
+                continue
+
+            row = connection.execute(
+                "select mtime from dirs where path = ?", (dir,)).fetchone()
+
+            if row is not None and row["mtime"] == mtime:
+                todo += [subdir for (subdir,) in connection.execute(
+                    "select path from dirs where parent = ?", (dir,))]
+            else:
+                todo += scan_dir(connection, dir, mtime)
+                listed += 1
+
+    print(f"Catalog: listed {listed} changed directories of {root}")
+
+
+def known_dir(path):
+    '''normalised path of a directory, refreshing it first if it isn't in
+    the catalog yet.'''
+
+    path = os.path.normpath(path)
+
+    row = connect().execute(
+        "select 1 from dirs where path = ?", (path,)).fetchone()
+    if row is None:
+        refresh(path)
+
+    return path
+
+
+def list_dir(path):
+    '''sorted names of the subdirectories and the catalogued files of a
+    directory, in place of listing it.'''
+
+    path = known_dir(path)
+    connection = connect()
+
+    names = [os.path.basename(subdir) for (subdir,) in connection.execute(
+        "select path from dirs where parent = ?", (path,))]
+    names += [name for (name,) in connection.execute(
+        "select name from files where dir = ?", (path,))]
+
+    return sorted(names)
+
+
+def find(path=None, **facets):
+    '''catalogued files matching facets, e.g. type="yearmax", in the
+    directory path if given, else anywhere in the tree. Returns a list of
+    dicts of each file's path, name and facets, sorted by path.'''
+
+    conditions = []
+    values = []
+
+    if path is not None:
+        conditions.append("dir = ?")
+        values.append(known_dir(path))
+
+    for facet, value in facets.items():
+        if facet not in path_facets + name_facets:
+            raise ValueError(f"Unknown facet: {facet}")
+        conditions.append(f"{facet} = ?")
+        values.append(value)
+
+    query = "select * from files"
+    if conditions:
+        query = f"{query} where {' and '.join(conditions)}"
+
+    rows = connect().execute(f"{query} order by path", values)
+
+    return [dict(row) for row in rows]
@@ -0,0 +1,202 @@
+"""
+File: cdo_runner.py
+Author: riley cooper
+Email: rwr.cooper@gmail.com
+Description:
+    Runs the remaining cdo commands of the scripts as asyncio subprocesses,
+    at most limit at once, so the independent commands of a task (e.g. the
+    cities of a model) overlap instead of running one at a time. Commands
+    are given as chains, lists of shell commands run in order, each chain
+    stopping at its first failure. The stdout, stderr, exit status and wall
+    time of each command are kept. Commands failing with a transient error
+    (see transient_errors) are retried, other failures are reported once
+    every chain has finished and raised as a CommandError. fuse composes
+    the operators making an output into a single chained cdo command, so no
+    intermediate files are written.
+"""
+
+
+import asyncio
+import os
+import time
+
+
+# retries of a command failing with a transient error and the delay in
+# seconds before the first retry, doubled for each retry after it
+retries = 2
+retry_delay = 5
+
+
+# stderr of failures worth retrying, e.g. from a busy file system
+transient_errors = [
+    "Resource temporarily unavailable",
+    "Too many open files",
+    "Input/output error",
+    "Stale file handle",
+    "NetCDF: HDF error",
+]
+
+
+# operators writing several outputs, which can only end a chain, and
+# operators reading a variable number of inputs, which can only start one
+multi_output_operators = ["trend", "eof", "eoftime", "eofspatial", "split"]
+multi_input_operators = ["mergetime", "merge", "cat", "ens"]
+
+
+class CommandError(Exception):
+    '''raised when commands have failed, failed is the list of their
+    results.'''
+
+    def __init__(self, failed):
+        self.failed = failed
+
+        cmds = "\n".join(f"    {result['cmd']}" for result in failed)
+        super().__init__(f"{len(failed)} commands failed:\n{cmds}")
+
+
+def operator_name(operator):
+    '''name of an operator such as selyear,2000/2100.'''
+
+    return operator.split(",")[0].split()[0]
+
+
+def fuse(operators, infiles, outfiles, options=None):
+    '''a single cdo command applying operators, innermost first (e.g.
+    ["selyear,2000/2100", "fldmean"]), to infiles and writing outfiles,
+    without intermediate files. An operator may carry its own extra inputs,
+    e.g. "ifthen mask.nc". options is a list of cdo options, e.g. of the
+    output format. Raises a ValueError if the operators can't be fused, they
+    then need separate commands with the intermediate written to a file.'''
+
+    names = [operator_name(operator) for operator in operators]
+
+    for i, name in enumerate(names):
+        if (i < len(names) - 1 and
+                any(name.startswith(op) for op in multi_output_operators)):
+            raise ValueError(f"{name} writes several outputs, it can only "
+                             f"be the last operator of a chain")
+
+        if (i > 0 and
+                any(name.startswith(op) for op in multi_input_operators)):
+            raise ValueError(f"{name} reads several inputs, it can only be "
+                             f"the first operator of a chain")
+
+    if len(infiles) > 1 and not any(
+            names[0].startswith(op) for op in multi_input_operators):
+        raise ValueError(f"{names[0]} reads a single input, not "
+                         f"{len(infiles)}")
+
+    chain = " ".join(f"-{operator}" for operator in reversed(operators))
+    options = " ".join(["-L"] + (options or []))
+
+    return f"cdo {options} {chain} {' '.join(infiles)} {' '.join(outfiles)}"
+
+
+def transient(result):
+    '''True if a failed command's stderr shows a transient error.'''
+
+    return any(error in result["stderr"] for error in transient_errors)
+
+
+async def run_command(cmd, semaphore):
+    '''runs a shell command once semaphore has a free slot, retrying
+    transient failures. Returns a dict of the cmd, its returncode, stdout,
+    stderr, wall time in seconds and number of attempts.'''
+
+    for attempt in range(retries + 1):
+        async with semaphore:
+            print(f"Running command: {cmd}")
+
+            start = time.monotonic()
+            process = await asyncio.create_subprocess_shell(
+                cmd, stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE)
+            stdout, stderr = await process.communicate()
+
+        result = {
+            "cmd": cmd,
+            "returncode": process.returncode,
+            "stdout": stdout.decode(errors="replace"),
+            "stderr": stderr.decode(errors="replace"),
+            "seconds": time.monotonic() - start,
+            "attempts": attempt + 1,
+        }
+
+        if result["returncode"] == 0:
+            print(f"Finished in {result['seconds']:.1f}s: {cmd}")
+            return result
+
+        if attempt == retries or not transient(result):
+            break
+
+        # wait without holding the slot
+        delay = retry_delay * 2 ** attempt
+        print(f"Transient failure, retrying in {delay}s: {cmd}")
+        await asyncio.sleep(delay)
+
+    print(f"Command failed with exit status {result['returncode']} after "
+          f"{result['attempts']} attempts: {cmd}")
+    print(result["stderr"])
+
+    return result
+
+
+async def run_chain(chain, semaphore):
+    '''runs the commands of a chain in order, stopping at the first that
+    fails. Returns the list of their results.'''
+
+    results = []
+    for cmd in chain:
+        result = await run_command(cmd, semaphore)
+        results.append(result)
+
+        if result["returncode"] != 0:
+            break
+
+    return results
+
+
+async def run_chains(chains, limit):
+    '''runs chains concurrently, at most limit commands at once.'''
+
+    semaphore = asyncio.Semaphore(limit)
+
+    return await asyncio.gather(
+        *[run_chain(chain, semaphore) for chain in chains])
+
+
+def succeeded(chain_results):
+    '''True if every command of a chain succeeded.'''
+
+    return all(result["returncode"] == 0 for result in chain_results)
+
+
+def raise_failures(results):
+    '''raises a CommandError if any of the chains of results failed.'''
+
+    failed = [chain_results[-1] for chain_results in results
+              if not succeeded(chain_results)]
+
+    if failed:
+        raise CommandError(failed)
+
+
+def run(chains, limit=None, check=True):
+    '''runs chains, a list of commands or of lists of commands to run in
+    order, with at most limit (default the number of cpus) commands at once.
+    Returns a list of the results of the commands of each chain. With check
+    a CommandError is raised, once every chain has finished, if any
+    failed.'''
+
+    if limit is None:
+        limit = os.cpu_count()
+
+    chains = [[chain] if isinstance(chain, str) else chain
+              for chain in chains]
+
+    results = asyncio.run(run_chains(chains, limit))
+
+    if check:
+        raise_failures(results)
+
+    return results
@@ -0,0 +1,167 @@
+"""
+File: download_manifest.py
+Author: riley cooper
+Email: rwr.cooper@gmail.com
+Description:
+    Manifest of the downloaded files of each data set, in place of counting
+    the netcdf files in its directory. The manifest of a data set lists the
+    files ESGF has for it (name, url, size and checksum) and the result of
+    verifying each one on disk: its size, mtime and the checksum it was
+    found to have. A file is only rehashed when its size or mtime has
+    changed since it was verified. Files are hashed in blocks on a pool of
+    threads. Missing files, and files of the wrong size or checksum, are
+    the ones to download. Manifests are json files in manifest_path, one
+    per data set.
+"""
+
+
+import hashlib
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+import journal
+
+
+manifest_path = "data-link/cordex-data/manifest/downloads"
+
+
+def manifest_file(dataset_id):
+    '''path of the manifest of a data set.'''
+
+    key = hashlib.sha1(dataset_id.encode()).hexdigest()
+    return f"{manifest_path}/{key}.json"
+
+
+def read(dataset_id):
+    '''the manifest of a data set, None if there isn't one.'''
+
+    try:
+        with open(manifest_file(dataset_id)) as reader:
+            return json.load(reader)
+    except (OSError, ValueError):
+        return None
+
+
+def write(manifest):
+    '''saves a manifest.'''
+
+    file = manifest_file(manifest["dataset_id"])
+    os.makedirs(os.path.dirname(file), exist_ok=True)
+
+    def write_manifest(temp):
+        with open(temp, "w") as writer:
+            json.dump(manifest, writer, indent=1)
+
+    journal.atomic_write(file, write_manifest)
+
+
+def update(dataset_id, download_dir, files):
+    '''the manifest of a data set with the files ESGF has for it, a list of
+    dicts of url, path, size, checksum and checksum_type, keeping the
+    verification of the files still listed.'''
+
+    old = read(dataset_id) or {"verified": {}}
+
+    manifest = {
+        "dataset_id": dataset_id,
+        "dir": download_dir,
+        "files": {os.path.basename(file["path"]): {
+            "url": file["url"],
+            "size": file["size"],
+            "checksum": file.get("checksum"),
+            "checksum_type": file.get("checksum_type"),
+        } for file in files},
+    }
+    manifest["verified"] = {
+        name: state for name, state in old["verified"].items()
+        if name in manifest["files"]}
+
+    write(manifest)
+
+    return manifest
+
+
+def file_checksum(file, checksum_type, block_size=2**20):
+    '''checksum of a file's content of checksum_type, e.g. SHA256 or MD5,
+    read in blocks.'''
+
+    checksum = hashlib.new(checksum_type.lower())
+    with open(file, "rb") as reader:
+        for block in iter(lambda: reader.read(block_size), b""):
+            checksum.update(block)
+
+    return checksum.hexdigest()
+
+
+def file_state(path, expected, old_state=None):
+    '''size, mtime and checksum of a downloaded file, the checksum is reused
+    from old_state if the size and mtime haven't changed. Files of the
+    wrong size aren't hashed.'''
+
+    stat = os.stat(path)
+    state = {"size": stat.st_size, "mtime": stat.st_mtime, "checksum": None}
+
+    if expected["size"] is not None and stat.st_size != expected["size"]:
+        return state
+
+    if not expected["checksum"]:
+        return state
+
+    if (old_state is not None and old_state["size"] == state["size"] and
+            old_state["mtime"] == state["mtime"] and old_state["checksum"]):
+        state["checksum"] = old_state["checksum"]
+    else:
+        print(f"Verifying: {path}")
+        state["checksum"] = file_checksum(path, expected["checksum_type"])
+
+    return state
+
+
+def good(expected, state):
+    '''True if the state of a file matches what ESGF has for it.'''
+
+    if expected["size"] is not None and state["size"] != expected["size"]:
+        return False
+
+    if expected["checksum"]:
+        return state["checksum"] == expected["checksum"].lower()
+
+    return True
+
+
+def verify(manifest, jobs=4):
+    '''verifies the files of a manifest on disk, hashing those changed since
+    their last verification on jobs threads, and saves the results. Files
+    found bad are removed. Returns the list of files to download, as dicts
+    of url, path and size.'''
+
+    names = [name for name in manifest["files"]
+             if os.path.exists(f"{manifest['dir']}/{name}")]
+
+    def check(name):
+        return file_state(
+            f"{manifest['dir']}/{name}", manifest["files"][name],
+            manifest["verified"].get(name))
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        states = dict(zip(names, executor.map(check, names)))
+
+    todo = []
+    for name, expected in manifest["files"].items():
+        path = f"{manifest['dir']}/{name}"
+
+        if name in states and good(expected, states[name]):
+            manifest["verified"][name] = states[name]
+            continue
+
+        if name in states:
+            print(f"Bad file, size or checksum doesn't match ESGF: {path}")
+            os.remove(path)
+
+        manifest["verified"].pop(name, None)
+        todo.append({"url": expected["url"], "path": path,
+                     "size": expected["size"]})
+
+    write(manifest)
+
+    return todo
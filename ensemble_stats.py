@@ -0,0 +1,156 @@
+"""
+File: ensemble_stats.py
+Author: riley cooper
+Email: rwr.cooper@gmail.com
+Description:
+    Per grid cell statistics of an ensemble of fields, computed by adding one
+    member at a time so memory doesn't grow with the number of members.
+    add_member keeps the running count, mean, sum of squared deviations, min
+    and max and the counts of positive and negative values. The median and
+    quartiles come from a second pass over the members, filling a histogram
+    of bins bins per cell between the min and max of the first pass, so they
+    are within a bin width, (max - min) / bins, of numpy.quantile's.
+"""
+
+
+import numpy as np
+
+
+# bins of the histogram of each cell
+bins = 200
+
+
+def add_member(stats, values):
+    '''adds the values of an ensemble member to the running count, mean,
+    sum of squared deviations (m2), min, max and counts of positive and
+    negative values of the members so far, ignoring missing values. stats is
+    None for the first member.'''
+
+    values = values.astype("float64")
+    valid = ~np.isnan(values)
+
+    if stats is None:
+        stats = {
+            "count": np.zeros(values.shape),
+            "mean": np.zeros(values.shape),
+            "m2": np.zeros(values.shape),
+            "min": np.full(values.shape, np.nan),
+            "max": np.full(values.shape, np.nan),
+            "positive": np.zeros(values.shape),
+            "negative": np.zeros(values.shape),
+        }
+
+    # Welford's update, one member at a time
+    count = stats["count"] + valid
+    delta = np.where(valid, values - stats["mean"], 0)
+    mean = stats["mean"] + delta / np.maximum(count, 1)
+
+    stats["m2"] += np.where(valid, delta * (values - mean), 0)
+    stats["mean"] = mean
+    stats["count"] = count
+    stats["min"] = np.fmin(stats["min"], values)
+    stats["max"] = np.fmax(stats["max"], values)
+    stats["positive"] += valid & (values > 0)
+    stats["negative"] += valid & (values < 0)
+
+    return stats
+
+
+def new_histogram(stats):
+    '''empty histogram of each cell over the range of the members in stats,
+    the running statistics of a first pass over them.'''
+
+    low = np.where(np.isnan(stats["min"]), 0, stats["min"])
+    high = np.where(np.isnan(stats["max"]), 0, stats["max"])
+
+    return {
+        "low": low,
+        "width": (high - low) / bins,
+        "counts": np.zeros((bins,) + low.shape, dtype="int32"),
+    }
+
+
+def add_to_histogram(histogram, values):
+    '''adds the values of an ensemble member to the histogram of each
+    cell.'''
+
+    values = values.astype("float64")
+    valid = ~np.isnan(values)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        position = (values - histogram["low"]) / histogram["width"]
+
+    # cells with a single value over the members have a single bin
+    position = np.where(histogram["width"] > 0, position, 0)
+    bin = np.clip(np.nan_to_num(position), 0, bins - 1).astype("int64")
+
+    # one value per cell, so each cell's bin is added to once
+    cells = np.flatnonzero(valid)
+    counts = histogram["counts"].reshape(bins, -1)
+    counts[bin.ravel()[cells], cells] += 1
+
+    return histogram
+
+
+def order_statistic(histogram, k):
+    '''the k-th smallest value (from 0) of each cell, placed within the bin
+    of the histogram it falls in by its rank among the values of the bin.'''
+
+    counts = histogram["counts"]
+    cumulative = np.cumsum(counts, axis=0)
+
+    # first bin holding more than k values and the count before it
+    bin = np.argmax(cumulative > k[np.newaxis], axis=0)
+    in_bin = np.take_along_axis(counts, bin[np.newaxis], axis=0)[0]
+    before = np.take_along_axis(cumulative, bin[np.newaxis], axis=0)[0]
+    before = before - in_bin
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        fraction = np.where(in_bin > 0, (k - before + 0.5) / in_bin, 0.5)
+
+    return histogram["low"] + histogram["width"] * (bin + fraction)
+
+
+def quantile(histogram, q):
+    '''the q quantile of each cell, interpolated between the order
+    statistics either side of it as numpy.quantile does. Cells without values
+    are nan.'''
+
+    total = histogram["counts"].sum(axis=0)
+
+    rank = q * np.maximum(total - 1, 0)
+    below = np.floor(rank)
+    above = np.minimum(below + 1, np.maximum(total - 1, 0))
+
+    values = (order_statistic(histogram, below) * (1 - (rank - below)) +
+              order_statistic(histogram, above) * (rank - below))
+
+    return np.where(total > 0, values, np.nan)
+
+
+def statistics(stats, histogram):
+    '''the ensemble statistics of each cell from the running statistics and
+    histogram of the members: mean, std, median, q25, q75, iqr (q75 - q25)
+    and agreement, the fraction of the members agreeing on the sign of the
+    ensemble mean. Cells without values are nan.'''
+
+    count = stats["count"]
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        std = np.sqrt(stats["m2"] / count)
+        same_sign = np.where(stats["mean"] >= 0, stats["positive"],
+                             stats["negative"])
+        agreement = same_sign / count
+
+    fields = {
+        "mean": stats["mean"],
+        "std": std,
+        "median": quantile(histogram, 0.5),
+        "q25": quantile(histogram, 0.25),
+        "q75": quantile(histogram, 0.75),
+        "agreement": agreement,
+    }
+    fields["iqr"] = fields["q75"] - fields["q25"]
+
+    return {name: np.where(count > 0, field, np.nan)
+            for name, field in fields.items()}
@@ -0,0 +1,203 @@
+"""
+File: fetcher.py
+Author: riley cooper
+Email: rwr.cooper@gmail.com
+Description:
+    Concurrent downloads of files over http(s), used by model_downloader.py
+    in place of the wget scripts of ESGF. Files are fetched by a pool of
+    connections threads, each streamed to <file>.part in its final
+    directory and renamed into place once complete, so an incomplete file
+    never has its final name. A .part file left by a run that died is
+    continued with an HTTP Range request. Failed fetches are retried,
+    continuing from what they got. The bandwidth of each data node (host of
+    the url) can be capped at max_rate bytes per second, shared by all the
+    downloads from it.
+"""
+
+
+import os
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+
+# bytes read from a response at a time
+chunk_size = 1 << 20
+
+
+# seconds before a connection without data is given up
+timeout = 120
+
+
+# retries of a failed fetch and the delay in seconds before the first retry,
+# doubled for each retry after it
+retries = 3
+retry_delay = 5
+
+
+# multipliers of the suffixes of a rate, e.g. 20M
+rate_units = {"k": 1e3, "M": 1e6, "G": 1e9}
+
+
+def parse_rate(rate):
+    '''bytes per second of a rate such as 500k, 20M or 1G, None for no
+    cap.'''
+
+    if rate is None:
+        return None
+
+    if rate[-1] in rate_units:
+        return float(rate[:-1]) * rate_units[rate[-1]]
+
+    return float(rate)
+
+
+def new_limiter(rate):
+    '''bandwidth limiter of rate bytes per second, shared by threads.'''
+
+    return {"rate": rate, "next": time.monotonic(), "lock": threading.Lock()}
+
+
+def throttle(limiter, size):
+    '''waits until size bytes can be read within the rate of limiter, each
+    read takes the next free slot of size / rate seconds.'''
+
+    if limiter is None or not limiter["rate"]:
+        return
+
+    with limiter["lock"]:
+        now = time.monotonic()
+        start = max(limiter["next"], now)
+        limiter["next"] = start + size / limiter["rate"]
+
+    if start > now:
+        time.sleep(start - now)
+
+
+def part_file(path):
+    '''file a download is written to until it is complete.'''
+
+    return f"{path}.part"
+
+
+def fetch(file, limiter=None, context=None):
+    '''downloads a single file, a dict of its url, path and size (None if
+    unknown), continuing its .part file if there is one. Returns the number
+    of bytes read.'''
+
+    part = part_file(file["path"])
+    offset = os.path.getsize(part) if os.path.exists(part) else 0
+
+    request = urllib.request.Request(file["url"])
+    if offset:
+        request.add_header("Range", f"bytes={offset}-")
+
+    read = 0
+
+    try:
+        response = urllib.request.urlopen(
+            request, timeout=timeout, context=context)
+    except urllib.error.HTTPError as error:
+        # a .part holding the whole file, e.g. killed before its rename
+        if error.code != 416 or offset != file.get("size"):
+            raise
+    else:
+        with response:
+            # servers ignoring the range send the whole file again
+            if offset and response.status != 206:
+                offset = 0
+
+            with open(part, "ab" if offset else "wb") as writer:
+                while True:
+                    block = response.read(chunk_size)
+                    if not block:
+                        break
+                    throttle(limiter, len(block))
+                    writer.write(block)
+                    read += len(block)
+
+    size = os.path.getsize(part)
+    if file.get("size") is not None and size != file["size"]:
+        raise IOError(f"Incomplete download of {file['url']}: {size} of "
+                      f"{file['size']} bytes")
+
+    os.replace(part, file["path"])
+
+    return read
+
+
+def transient(error):
+    '''True if a failed fetch is worth retrying, anything but a client error
+    such as a missing file or a refused logon.'''
+
+    if isinstance(error, urllib.error.HTTPError):
+        return error.code >= 500 or error.code in [408, 429]
+
+    return True
+
+
+def fetch_with_retries(file, limiter=None, context=None):
+    '''fetch, retrying failures after a delay. Each retry continues from
+    what the last attempt wrote.'''
+
+    for attempt in range(retries + 1):
+        try:
+            return fetch(file, limiter, context)
+        except (urllib.error.URLError, OSError) as error:
+            if attempt == retries or not transient(error):
+                raise
+
+            delay = retry_delay * 2 ** attempt
+            print(f"Fetch failed ({error}), retrying in {delay}s: "
+                  f"{file['url']}")
+            time.sleep(delay)
+
+
+def download(files, connections=4, max_rate=None, context=None):
+    '''downloads files, a list of dicts of url, path and size, on
+    connections threads with at most max_rate bytes per second from each
+    data node. Files already at their path are skipped. Returns the list of
+    (file, error) of the downloads that failed.'''
+
+    files = [file for file in files if not os.path.exists(file["path"])]
+
+    limiters = {}
+    for file in files:
+        node = urllib.parse.urlparse(file["url"]).netloc
+        if node not in limiters:
+            limiters[node] = new_limiter(max_rate)
+
+    def task(file):
+        node = urllib.parse.urlparse(file["url"]).netloc
+        start = time.monotonic()
+        read = fetch_with_retries(file, limiters[node], context)
+        seconds = time.monotonic() - start
+
+        print(f"Downloaded {read / 1e6:.1f} MB in {seconds:.1f}s: "
+              f"{file['path']}")
+
+    failures = []
+
+    with ThreadPoolExecutor(max_workers=connections) as executor:
+        running = {executor.submit(task, file): file for file in files}
+
+        for future in as_completed(running):
+            file = running[future]
+            try:
+                future.result()
+            except Exception as error:
+                part = part_file(file["path"])
+                if os.path.exists(part) and os.path.getsize(part) > 0:
+                    print(f"Download failed ({error}), partial file kept: "
+                          f"{file['url']}")
+                else:
+                    print(f"Download failed ({error}): {file['url']}")
+                failures.append((file, error))
+
+    print(f"Downloads: {len(files) - len(failures)} of {len(files)} files "
+          f"succeeded.")
+
+    return failures
@@ -0,0 +1,137 @@
+"""
+File: journal.py
+Author: riley cooper
+Email: rwr.cooper@gmail.com
+Description:
+    Crash safe runs. Outputs are written under a temporary name next to
+    their final path and renamed into place once complete (atomic_outfiles),
+    so a run that dies partway never leaves half written files where later
+    runs would trust them. atomic_write does the same for a single file such
+    as a manifest record, index or cache entry. Each run also keeps a
+    journal of the tasks it has completed, a jsonl file in journal_path with
+    a line per (stage, key) synced to disk as soon as the task is done, so a
+    run started again with the resume option skips exactly the tasks already
+    done. Without resume a run starts a new journal.
+"""
+
+
+import contextlib
+import json
+import os
+import shutil
+
+
+journal_path = "data-link/cordex-data/journal"
+
+
+def journal_file(run):
+    '''path of the journal of a run, a name such as rcp_mon_EUR-44_all.'''
+
+    return f"{journal_path}/{run}.jsonl"
+
+
+def start(run, resume):
+    '''starts the journal of a run, continuing the existing one with resume
+    and clearing it otherwise.'''
+
+    os.makedirs(journal_path, exist_ok=True)
+
+    if not resume and os.path.exists(journal_file(run)):
+        os.remove(journal_file(run))
+
+
+def completed(run, stage):
+    '''the keys of the tasks of stage the journal of run has as done.'''
+
+    keys = set()
+
+    try:
+        with open(journal_file(run)) as reader:
+            for line in reader:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # the last line of a run killed while writing it
+                    continue
+
+                if entry["stage"] == stage:
+                    keys.add(entry["key"])
+    except FileNotFoundError:
+        pass
+
+    return keys
+
+
+def record(run, stage, key):
+    '''records in the journal of run that the task key of stage is done.'''
+
+    with open(journal_file(run), "a") as writer:
+        writer.write(json.dumps({"stage": stage, "key": key}) + "\n")
+        writer.flush()
+        os.fsync(writer.fileno())
+
+
+def temp_file(file, unique=False):
+    '''temporary name of a file being written, in the same directory so it
+    can be renamed into place. With unique the name holds the process id, so
+    processes writing the same file at once don't share it.'''
+
+    if unique:
+        return f"{file}.{os.getpid()}.tmp"
+
+    return f"{file}.tmp"
+
+
+def remove(file):
+    '''removes a file or directory if it exists.'''
+
+    if os.path.isdir(file):
+        shutil.rmtree(file)
+    elif os.path.exists(file):
+        os.remove(file)
+
+
+def atomic_write(file, writer):
+    '''writes file atomically, writer is a function writing the file to the
+    path it is given, a temporary file renamed to file once complete and
+    removed if writer fails. A directory, such as a zarr store, replaces the
+    old one.'''
+
+    temp = temp_file(file, unique=True)
+    remove(temp)
+
+    try:
+        writer(temp)
+
+        if os.path.isdir(temp):
+            remove(file)
+        os.replace(temp, file)
+    except BaseException:
+        remove(temp)
+        raise
+
+
+@contextlib.contextmanager
+def atomic_outfiles(outfiles):
+    '''writes outfiles, a dict of outfile keyed by e.g. type or city,
+    atomically. Yields a dict of the temporary files to write instead, the
+    ones written are renamed into place when the block finishes and all are
+    removed if it fails.'''
+
+    temp_files = {key: temp_file(outfile)
+                  for key, outfile in outfiles.items()}
+
+    # left by a run that died while writing them
+    for file in temp_files.values():
+        remove(file)
+
+    try:
+        yield temp_files
+    except BaseException:
+        for file in temp_files.values():
+            remove(file)
+        raise
+
+    for key, outfile in outfiles.items():
+        if os.path.exists(temp_files[key]):
+            os.replace(temp_files[key], outfile)
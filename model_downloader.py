@@ -15,8 +15,27 @@ Description:
 
     Saves data to "data-link", this needs to be created first.
 
+    The files of every data set of the search are downloaded together,
+    connections at a time, with the bandwidth from each data node capped at
+    max_rate, see fetcher.py. Each file is streamed to a .part file in its
+    data directory and renamed once complete, so a download that dies
+    partway never leaves incomplete files in the data directory, and the
+    next run continues the .part files with HTTP Range requests. The files
+    ESGF has for each data set (names, sizes and checksums) are kept in a
+    manifest, the files on disk are verified against it on hash_jobs
+    threads and only the missing or bad ones are downloaded, see
+    download_manifest.py. Data sets are recorded in the journal of the
+    search when all their files are verified, with the resume option a run
+    skips those an earlier run of the same search completed, see
+    journal.py.
+
+    The searches of ESGF are cached on disk for ttl hours, see
+    search_cache.py. With the offline option only the cache is used and
+    nothing is downloaded, the run only verifies the files on disk and lists
+    those still to download.
+
 Usage:
-    model_downloader -d <domain>... -v <variable>... -t <time_frequency>... -e <experiment>... [-g <driving_model>]...[-r <rcm_name>]...
+    model_downloader -d <domain>... -v <variable>... -t <time_frequency>... -e <experiment>... [-g <driving_model>]...[-r <rcm_name>]... [-n <connections>] [--max_rate=<rate>] [--hash_jobs=<hash_jobs>] [--resume] [--ttl=<hours>] [--offline] [--search_cache=<dir>]
 
 Options:
     -d <domain>, --domains=<domain>
@@ -25,17 +44,28 @@ Options:
     -e <experiment>, --experiments=<experiment>
     -g <driving_model>, --driving_models=<driving_model>
     -r <rcm_name>, --rcm_names=<rcm_name>
+    -n <connections>, --connections=<connections>  files downloaded at once [default: 4]
+    --max_rate=<rate>  bytes per second from each data node, e.g. 20M
+    --hash_jobs=<hash_jobs>  files verified at once [default: 4]
+    --resume  skip the data sets an earlier run of the search completed
+    --ttl=<hours>  hours the cached searches of ESGF are reused [default: 24]
+    --offline  only use the cached searches of ESGF
+    --search_cache=<dir>  directory of the cached searches of ESGF
 
     -h, --help
     --option=<n>
 """
 
-from pyesgf.search import SearchConnection
 import os
 from pyesgf.logon import LogonManager
 import ssl
-import tempfile
+import hashlib
+import json
 from docopt import docopt
+import download_manifest
+import fetcher
+import journal
+import search_cache
 
 ssl._create_default_https_context = ssl._create_unverified_context
 
@@ -48,14 +78,21 @@ password = 'ZjLaYpWNP0*'
 openid_c = 'riley'
 
 
-def connection():
-    '''creates a connection to ESGF'''
+# credentials saved by the logon, presented to the data nodes
+credentials = os.path.expanduser("~/.esg/credentials.pem")
+
+
+# run options, set from the command line in main
+config = {
+    "connections": 4,
+    "max_rate": None,
+    "hash_jobs": 4,
+}
 
-    conn = SearchConnection('https://esgf-node.llnl.gov/esg-search',
-                            distrib=True)
 
-    # conn = SearchConnection('https://esgf-data.dkrz.de/search/esgf-dkrz/',
-    #                         distrib=True)
+def logon():
+    '''logs on to ESGF, saving the credentials presented to the data
+    nodes'''
 
     # openid = 'https://esgf.nci.org.au/esgf-idp/openid/riley'
 
@@ -66,7 +103,6 @@ def connection():
         lm.logon_with_openid(openid, password, bootstrap=True)
 
     print("Connection secured.")
-    return conn
 
 
 meta_data = ['time_frequency', 'domain', 'variable', 'experiment',
@@ -75,13 +111,12 @@ meta_data = ['time_frequency', 'domain', 'variable', 'experiment',
 file_path = "data-link/cordex-data"
 
 
-def make_path(result):
+def make_path(ds_json):
     '''Makes a path to where the data will be saved.'''
 
     file_path = "data-link/cordex-data"
 
     path_list = []
-    ds_json = result.json
     for data in meta_data:
 
         to_append = ds_json[data][0]
@@ -93,68 +128,133 @@ def make_path(result):
     return dir
 
 
-def download_data(result, download_dir):
-    '''Downoads a single data set from a search of ESGF and saves in given
-    directory (path).'''
+def dataset_files(dataset_id, download_dir):
+    '''the files of a data set from a search of ESGF, as dicts of their
+    url, path in download_dir, size and checksum.'''
+
+    files = []
+    for file in search_cache.files(dataset_id):
+        files.append({
+            "url": file["download_url"],
+            "path": f"{download_dir}/{file['filename']}",
+            "size": file["size"],
+            "checksum": file["checksum"],
+            "checksum_type": file["checksum_type"],
+        })
+
+    return files
+
+
+def ssl_context():
+    '''ssl context of the downloads, with the credentials of the logon when
+    there are some.'''
+
+    context = ssl._create_default_https_context()
+    if os.path.exists(credentials):
+        context.load_cert_chain(credentials)
+
+    return context
+
+
+def download_data(datasets):
+    '''Downloads the files of datasets, a dict of the list of files of each
+    data set (see dataset_files) keyed by dataset id, all together. Returns
+    the ids of the data sets whose files all downloaded.'''
+
+    files = [file for dataset in datasets.values() for file in dataset]
 
-    fc = result.file_context()
-    wget_script_content = fc.get_download_script()
+    failures = fetcher.download(
+        files, connections=config["connections"],
+        max_rate=fetcher.parse_rate(config["max_rate"]),
+        context=ssl_context())
 
-    script_path = tempfile.mkstemp(suffix='.sh', prefix='download-')[1]
-    with open(script_path, "w") as writer:
-        writer.write(wget_script_content)
+    failed = {file["path"] for file, _ in failures}
 
-    print(f'Runnng script: {script_path}')
+    return [dataset_id for dataset_id, dataset in datasets.items()
+            if not any(file["path"] in failed for file in dataset)]
 
-    os.system(f"bash {script_path}")
-    os.system(f"mv *nc {download_dir}")
 
+def search_run(search_args):
+    '''name of the journal of a search.'''
 
-def download_cordex_data(search_args):
+    key = json.dumps(search_args, sort_keys=True).encode()
+
+    return f"download_{hashlib.sha1(key).hexdigest()[:12]}"
+
+
+def download_cordex_data(search_args, resume=False):
     '''Searches ESGF and downloads all data that matches the search.'''
 
-    print("Creating connection.")
-    conn = connection()
+    run = search_run(search_args)
+    journal.start(run, resume)
+    done = journal.completed(run, "download")
 
-    ctx = conn.new_context(
-        project='CORDEX',
-        domain=search_args["domains"],
-        time_frequency=search_args["time_frequencies"],
-        variable=search_args["variables"],
-        experiment=search_args["experiments"],
-        driving_model=search_args["driving_models"],
-        rcm_name=search_args["rcm_names"]
-        )
+    constraints = {
+        "project": 'CORDEX',
+        "domain": search_args["domains"],
+        "time_frequency": search_args["time_frequencies"],
+        "variable": search_args["variables"],
+        "experiment": search_args["experiments"],
+        "driving_model": search_args["driving_models"],
+        "rcm_name": search_args["rcm_names"],
+    }
 
-    hc = ctx.hit_count
+    hc = search_cache.hit_count(constraints)
 
     if hc == 0:
         print("No models matching search arguments.")
     else:
         print(f"Number of datasets matching search arguments: {hc}")
 
-    for result in ctx.search(ignore_facet_check=True):
+    # the files still to download of each data set, and its manifest
+    datasets = {}
+    manifests = {}
 
-        download_dir_path = make_path(result)
+    for ds_json in search_cache.search(constraints):
+        dataset_id = ds_json["id"]
+
+        if dataset_id in done:
+            print(f"Already done: {dataset_id}")
+            continue
+
+        download_dir_path = make_path(ds_json)
         print(f"Saving files to: {download_dir_path}")
         os.makedirs(download_dir_path, exist_ok=True)
 
-        files_to_download = result.json["number_of_files"]
-        files_in_dir = len(
-            [file for file in os.listdir(download_dir_path) if ".nc" in file])
-
-        if not files_to_download == files_in_dir:
-            print(f"Downloading {files_to_download} files.")
-            print(f"Files to download: {files_to_download}")
-            print(f"Files currently in dir: {files_in_dir}")
-            # __import__('IPython').embed()
-            if files_in_dir == 0:
-                download_data(result, download_dir_path)
+        manifest = download_manifest.update(
+            dataset_id, download_dir_path,
+            dataset_files(dataset_id, download_dir_path))
+        todo = download_manifest.verify(manifest, config["hash_jobs"])
+
+        if todo:
+            print(f"Files to download: {len(manifest['files'])}")
+            print(f"Files verified in dir: "
+                  f"{len(manifest['files']) - len(todo)}")
+            datasets[dataset_id] = todo
+            manifests[dataset_id] = manifest
+        else:
+            print("Files already downloaded and verified.")
+            journal.record(run, "download", dataset_id)
+
+    if search_cache.config["offline"]:
+        files = sum(len(dataset) for dataset in datasets.values())
+        print(f"Offline, not downloading {files} files of {len(datasets)} "
+              f"data sets.")
+        return
+
+    # the logon for the data nodes
+    if datasets:
+        logon()
+
+    # the files of every data set share the connections
+    for dataset_id in download_data(datasets):
+
+        # only the new files are hashed
+        if download_manifest.verify(manifests[dataset_id],
+                                    config["hash_jobs"]):
+            print(f"Downloaded files failed verification: {dataset_id}")
         else:
-            if files_in_dir == files_to_download:
-                print("Files already downloaded.")
-            else:
-                print("Warning: files in directory != files to download.")
+            journal.record(run, "download", dataset_id)
 
 
 def make_search_args(args):
@@ -177,8 +277,26 @@ def make_search_args(args):
 
 def main(args):
 
+    if args.get('--connections'):
+        config["connections"] = int(args['--connections'])
+
+    if args.get('--max_rate'):
+        config["max_rate"] = args['--max_rate']
+
+    if args.get('--hash_jobs'):
+        config["hash_jobs"] = int(args['--hash_jobs'])
+
+    if args.get('--ttl'):
+        search_cache.config["ttl"] = float(args['--ttl']) * 3600
+
+    if args.get('--offline'):
+        search_cache.config["offline"] = True
+
+    if args.get('--search_cache'):
+        search_cache.cache_path = args['--search_cache']
+
     search_args = make_search_args(args)
-    download_cordex_data(search_args)
+    download_cordex_data(search_args, resume=args.get('--resume', False))
 
 
 if __name__ == '__main__':
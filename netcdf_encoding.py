@@ -0,0 +1,163 @@
+"""
+File: netcdf_encoding.py
+Author: riley cooper
+Email: rwr.cooper@gmail.com
+Description:
+    Encoding of the netcdf outputs of the scripts, from the policy in
+    policy_file, a json file of the settings of each kind of output (role):
+    yearly (the yearly cubes), timeseries (the city timeseries and their
+    ensemble means), map (the slope, timmean and ensemble maps) and trend
+    (the city trends of trend_value_table.py). The settings of a role are
+    those of default updated with its own:
+        dtype               dtype of the floating point data variables, null
+                            keeps theirs
+        compression         zlib, zstd or none
+        complevel           compression level
+        shuffle             byte shuffle before compressing
+        significant_digits  digits kept by quantization, null for lossless
+        quantize_mode       BitGroom, GranularBitRound or BitRound
+        chunks              chunk length along time, y and x (the last two
+                            dims), -1 or missing for the whole dim. null
+                            stores the variable contiguous and uncompressed,
+                            smallest for files of a few values
+    apply sets the encoding of the data variables of a data set before it is
+    written with to_netcdf or save_mfdataset, cdo_options gives the cdo
+    options of the same policy. cdo picks its own chunks.
+"""
+
+
+import json
+import math
+import numpy as np
+
+
+policy_file = "netcdf_encoding.json"
+
+
+# the policy of this process, read on first use
+state = {"policy": None, "file": None}
+
+
+# encodings of the inputs that don't carry over to a float output
+packing = ["scale_factor", "add_offset", "least_significant_digit",
+           "missing_value", "_FillValue", "contiguous", "chunksizes", "zlib",
+           "compression", "complevel", "shuffle", "significant_digits",
+           "quantize_mode", "dtype"]
+
+
+def policy(role):
+    '''the encoding settings of role, the default settings of policy_file
+    updated with those of role.'''
+
+    if state["file"] != policy_file:
+        with open(policy_file) as reader:
+            state["policy"] = json.load(reader)
+        state["file"] = policy_file
+
+    if role not in state["policy"]:
+        raise ValueError(f"No encoding of {role} in {policy_file}")
+
+    settings = dict(state["policy"].get("default", {}))
+    settings.update(state["policy"][role])
+
+    return settings
+
+
+def chunk_sizes(data_array, chunks, unlimited_dims=()):
+    '''chunk shape of a variable from the chunks of a policy, keyed by time,
+    y and x. Chunks along unlimited dims aren't limited to their current
+    length, the file grows into them.'''
+
+    names = {dim: "time" for dim in data_array.dims if dim == "time"}
+    spatial = [dim for dim in data_array.dims if dim != "time"]
+    if len(spatial) >= 2:
+        names[spatial[-2]] = "y"
+    if spatial:
+        names[spatial[-1]] = "x"
+
+    sizes = []
+    for dim, size in zip(data_array.dims, data_array.shape):
+        chunk = chunks.get(names.get(dim), -1)
+        if dim in unlimited_dims:
+            chunk = chunk if chunk > 0 else size
+        elif chunk < 0 or chunk > size:
+            chunk = size
+        sizes.append(max(chunk, 1))
+
+    return tuple(sizes)
+
+
+def variable_encoding(data_array, settings, unlimited_dims=()):
+    '''netcdf4 encoding of a floating point data variable.'''
+
+    encoding = {key: value for key, value in data_array.encoding.items()
+                if key not in packing}
+
+    if settings.get("dtype"):
+        encoding["dtype"] = np.dtype(settings["dtype"])
+    else:
+        encoding["dtype"] = data_array.dtype
+
+    if settings.get("significant_digits"):
+        encoding["significant_digits"] = settings["significant_digits"]
+        encoding["quantize_mode"] = settings.get(
+            "quantize_mode", "BitGroom")
+
+    chunks = settings.get("chunks", {})
+    if chunks is None or not data_array.ndim or 0 in data_array.shape:
+        if not unlimited_dims:
+            encoding["contiguous"] = True
+        return encoding
+
+    compression = settings.get("compression", "none")
+    if compression != "none":
+        encoding["compression"] = compression
+        encoding["complevel"] = settings.get("complevel", 4)
+        encoding["shuffle"] = settings.get("shuffle", True)
+
+    encoding["contiguous"] = False
+    encoding["chunksizes"] = chunk_sizes(data_array, chunks, unlimited_dims)
+
+    return encoding
+
+
+def apply(data_set, role, unlimited_dims=()):
+    '''sets the encoding of the floating point data variables of data_set
+    (in place, and returned) to the policy of role, for a file with
+    unlimited_dims as in to_netcdf.'''
+
+    settings = policy(role)
+
+    for var in data_set.data_vars:
+        if np.issubdtype(data_set[var].dtype, np.floating):
+            data_set[var].encoding = variable_encoding(
+                data_set[var], settings, unlimited_dims)
+
+    return data_set
+
+
+def cdo_options(role):
+    '''cdo options writing the policy of role: netcdf4 with the dtype,
+    compression and bit rounding of its significant digits.'''
+
+    settings = policy(role)
+
+    options = ["-f nc4"]
+
+    if settings.get("dtype") == "float32":
+        options.append("-b F32")
+    elif settings.get("dtype") == "float64":
+        options.append("-b F64")
+
+    compression = settings.get("compression", "none")
+    if compression == "zlib":
+        options.append(f"-z zip_{settings.get('complevel', 4)}")
+    elif compression == "zstd":
+        options.append(f"-z zstd_{settings.get('complevel', 4)}")
+
+    # cdo rounds to significant bits rather than digits
+    if settings.get("significant_digits"):
+        bits = math.ceil(settings["significant_digits"] * math.log2(10))
+        options.append(f"--nsb {min(bits, 23)}")
+
+    return options
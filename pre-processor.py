@@ -4,20 +4,46 @@ File: pre-processor.py
 Author: riley cooper
 Email: rwr.cooper@gmail.com
 Description:
-    Pre-processes CRODEX data to then be used in analyses. Executes the 4 types
-    of pre-processing we need to then produce intercomparrison plots.
-    Evaluation and rcp convert the models to yearly metrics through a yearsum
-    or yearmax depending on relevance to speci hazard.
+    Pre-processes CRODEX data to then be used in analyses. Executes the 5 types
+    of pre-processing we need to then produce intercomparrison plots:
+        evaluation  yearly metrics of the evaluation runs (the reducers
+                    option, yearsum, yearmax, ... depending on relevance to
+                    speci hazard)
+        rcp         yearly metrics of the historical and rcp85 runs, merged
+                    into a 1950-2100 file per model
+        timeseries  city timeseries of each model and the evaluation
+                    ensemble mean
+        slope       slope and timmean maps of each model
+        ensemble    per grid cell statistics of the maps of all the models
+    Each model of a stage is a task, outputs already up to date are skipped,
+    see build_manifest.py, journal.py, netcdf_encoding.py and catalog.py.
 
 Usage:
-    pre-processor.py evaluation -d <domain> [-v <var_option]
-    pre-processor.py rcp -d <domain> [-v <var_option]
-    pre-processor.py timeseries -d <domain> [-v <var_option]
-    pre-processor.py slope -d <domain> [-v <var_option]
+    pre-processor.py evaluation -d <domain> [-v <var_option] [-t <time_frequency>] [-b <backend>] [-r <reducers>] [-j <jobs>] [--stream] [--scheduler=<scheduler>] [--workers=<workers>] [--memory_limit=<limit>] [--cdo_jobs=<cdo_jobs>] [--encoding=<file>] [--force] [--resume]
+    pre-processor.py rcp -d <domain> [-v <var_option] [-t <time_frequency>] [-b <backend>] [-r <reducers>] [-j <jobs>] [-z <layouts>] [-c <compressor>] [--stream] [--scheduler=<scheduler>] [--workers=<workers>] [--memory_limit=<limit>] [--cdo_jobs=<cdo_jobs>] [--encoding=<file>] [--force] [--resume]
+    pre-processor.py timeseries -d <domain> [-v <var_option] [-t <time_frequency>] [-b <backend>] [-r <reducers>] [-j <jobs>] [--spread] [--scheduler=<scheduler>] [--workers=<workers>] [--memory_limit=<limit>] [--cdo_jobs=<cdo_jobs>] [--encoding=<file>] [--force] [--resume]
+    pre-processor.py slope -d <domain> [-v <var_option] [-t <time_frequency>] [-b <backend>] [-r <reducers>] [-j <jobs>] [-s <statistics>] [--scheduler=<scheduler>] [--workers=<workers>] [--memory_limit=<limit>] [--cdo_jobs=<cdo_jobs>] [--encoding=<file>] [--force] [--resume]
+    pre-processor.py ensemble -d <domain> [-v <var_option] [-t <time_frequency>] [-r <reducers>] [-j <jobs>] [--encoding=<file>] [--force] [--resume]
 
 Options:
     -d <domain>, --domain=<domain>
     -v <var_option>, --var_option=<var_option>
+    -t <time_frequency>, --time_frequency=<time_frequency>  [default: mon]
+    -b <backend>, --backend=<backend>  xarray or cdo [default: xarray]
+    -r <reducers>, --reducers=<reducers>
+    -j <jobs>, --jobs=<jobs>  number of processes [default: 1]
+    -z <layouts>, --zarr=<layouts>  zarr stores to write, map and/or series
+    -c <compressor>, --compressor=<compressor>  zstd[:level], blosc[:cname[:level]], gzip[:level] or none [default: zstd:3]
+    -s <statistics>, --statistics=<statistics>  of each period, from mean, std, min, max, p<percent> and gt<threshold>
+    --stream  reduce the data to yearly values one file at a time
+    --spread  add the ensemble spread to the evaluation ensemble mean
+    --scheduler=<scheduler>  run on dask, local or a scheduler address
+    --workers=<workers>  workers of the local dask cluster
+    --memory_limit=<limit>  memory limit per local dask worker [default: auto]
+    --cdo_jobs=<cdo_jobs>  cdo commands run at once by each task [default: 4]
+    --encoding=<file>  encoding policy of the outputs [default: netcdf_encoding.json]
+    --force  rebuild outputs even if they are up to date
+    --resume  skip the tasks an earlier run of the same stage completed
 
     -h, --help
     --option=<n>
@@ -26,12 +52,28 @@ Options:
 
 from docopt import docopt
 import xarray as xr
+import numpy as np
+import netCDF4
+import dask
 import os
-from ds_store_remover import ds_store_remover
+import sys
+import traceback
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+import spatial_index
+import build_manifest
+import catalog
+import cdo_runner
+import ensemble_stats
+import journal
+import netcdf_encoding
+import regrid
+import trend_kernel
+import zarr_store
 import json
 
 
-path = "data-link/cordex-data/mon"
+cordex_path = "data-link/cordex-data"
+path = f"{cordex_path}/mon"
 
 
 # load cities_lat_lon
@@ -39,42 +81,196 @@ dict = open("cities_lat_lon.json")
 cities_lat_lon = json.load(dict)
 
 
-dist = 1
+# periods of the statistics of the slope stage, those of the trend and of
+# the time-mean
+stats_periods = [(2000, 2100), (1981, 2010)]
+
+
+# global quantiles stored with each map written by the slope and ensemble
+# stages, e.g. for the colour limits of slope_plots_cordex.py
+quantile_levels = [0.01, 0.05, 0.1, 0.2, 0.8, 0.9, 0.95, 0.99]
+
+
+# run options, set from the command line in main
+config = {
+    "backend": "xarray",
+    "reducers": None,
+    "jobs": 1,
+    "stream": False,
+    "zarr": [],
+    "compressor": "zstd:3",
+    "spread": False,
+    "scheduler": None,
+    "statistics": [],
+    "cdo_jobs": 4,
+    "encoding": "netcdf_encoding.json",
+    "force": False,
+    "resume": False,
+    "journal": None,
+}
+
+
+def start_client(scheduler, workers, memory_limit):
+    '''starts the dask client of the scheduler option, on a LocalCluster of
+    workers processes with memory_limit each for local, else on the
+    scheduler at an address such as tcp://host:8786. Every dask compute of
+    this process then runs on the cluster.'''
+
+    # distributed is only needed with the scheduler option
+    from dask.distributed import Client, LocalCluster
+
+    if scheduler == "local":
+        cluster = LocalCluster(n_workers=workers, memory_limit=memory_limit)
+        client = Client(cluster)
+    else:
+        client = Client(scheduler)
+
+    print(f"Dask dashboard: {client.dashboard_link}")
+
+    return client
+
+
+def open_chunks():
+    '''chunks to open data sets with: dask arrays when running on a dask
+    cluster, lazily loaded numpy arrays otherwise.'''
+
+    if config["scheduler"]:
+        return {}
+
+    return None
+
+
+def init_worker(worker_config):
+    '''sets up a worker process of the task pool.'''
+
+    config.update(worker_config)
+    netcdf_encoding.policy_file = config["encoding"]
+
+    # workers exit without flushing, keep their prints when piped to a log
+    sys.stdout.reconfigure(line_buffering=True)
+
+    # the pool already uses every core, don't also thread inside each task
+    dask.config.set(scheduler="synchronous")
+
+
+def run_task(function, args):
+    '''runs a single task, returns the traceback if it fails.'''
+
+    try:
+        function(*args)
+    except Exception:
+        return traceback.format_exc()
+
+
+def run_tasks(tasks, stage):
+    '''runs tasks, a list of (key, function, args), on config["jobs"]
+    processes with at most two tasks per process queued at once. A failed
+    task doesn't stop the others, failures are summarised at the end and
+    returned as a list of (key, traceback). Completed tasks are recorded in
+    the journal of the run, with the resume option the tasks it already has
+    as done are skipped.'''
+
+    jobs = config["jobs"]
+    failures = []
+
+    if config["resume"]:
+        done = journal.completed(config["journal"], stage)
+        for key, function, args in tasks:
+            if key in done:
+                print(f"Already done: {key}")
+        tasks = [task for task in tasks if task[0] not in done]
+
+    def finished(key, error):
+        if error is None:
+            journal.record(config["journal"], stage, key)
+        else:
+            print(f"Task failed: {key}")
+            failures.append((key, error))
+
+    if jobs == 1:
+        for key, function, args in tasks:
+            finished(key, run_task(function, args))
+
+    else:
+        with ProcessPoolExecutor(max_workers=jobs, initializer=init_worker,
+                                 initargs=(config,)) as executor:
+            running = {}
+
+            def collect(done):
+                for future in done:
+                    key = running.pop(future)
+                    try:
+                        error = future.result()
+                    except Exception:
+                        error = traceback.format_exc()
+                    finished(key, error)
+
+            for key, function, args in tasks:
+                if len(running) >= 2 * jobs:
+                    done, _ = wait(running, return_when=FIRST_COMPLETED)
+                    collect(done)
+                running[executor.submit(run_task, function, args)] = key
+
+            collect(wait(running).done)
+
+    print(f"{stage}: {len(tasks) - len(failures)} of {len(tasks)} tasks "
+          f"succeeded.")
+    for key, error in failures:
+        print(f"Failed: {key}")
+        print(error)
+
+    return failures
+
+
+def run_cdo(chains):
+    '''runs cdo commands, or chains of commands run in order, with at most
+    config["cdo_jobs"] at once, see cdo_runner.py. Raises a CommandError if
+    any fail.'''
+
+    return cdo_runner.run(chains, limit=config["cdo_jobs"])
 
 
 def pre_process_data_given_var_option(path, domain, type, var):
     '''preprocesses data given choice of variable, domain and type, type can be
-    evaluation, rcp, timeseries or slope. '''
+    evaluation, rcp, timeseries, slope or ensemble. '''
 
     path_var = f"{path}/{var}"
 
+    failures = []
+
     if type == "evaluation":
-        pre_process_eval(path_var, domain, var)
+        failures += pre_process_eval(path_var, domain, var)
     elif type == "rcp":
-        pre_process_rcp85(path_var, domain, var)
+        failures += pre_process_rcp85(path_var, domain, var)
     elif type == "timeseries":
-        pre_process_timeseries(
+        failures += pre_process_timeseries(
             path_var,
             domain,
             var,
             cities_lat_lon,
             experiment="rcp85")
 
-        pre_process_timeseries(
+        failures += pre_process_timeseries(
             path_var,
             domain,
             var,
             cities_lat_lon,
             experiment="evaluation")
 
-        pre_process_eval_ensmean(
+        catalog.refresh(f"{path_var}/timeseries")
+
+        failures += pre_process_eval_ensmean(
             path,
             domain,
             var,
             cities_lat_lon)
 
     elif type == "slope":
-        pre_process_slope_timmean(path_var, domain, var)
+        failures += pre_process_slope_timmean(path_var, domain, var)
+    elif type == "ensemble":
+        failures += pre_process_ensemble(path_var, domain, var)
+
+    return failures
 
 
 def pre_process_data(path, domain, type, var_option):
@@ -82,14 +278,20 @@ def pre_process_data(path, domain, type, var_option):
 
     path = f"{path}/{domain}"
 
-    vars = ds_store_remover(os.listdir(path))
+    vars = catalog.list_dir(path)
+
+    failures = []
 
     if var_option is None:
         for var in vars:
-            pre_process_data_given_var_option(path, domain, type, var)
+            failures += pre_process_data_given_var_option(
+                path, domain, type, var)
 
     else:
-        pre_process_data_given_var_option(path, domain, type, var_option)
+        failures += pre_process_data_given_var_option(
+            path, domain, type, var_option)
+
+    return failures
 
 
 def pre_process_eval(path, domain, var):
@@ -98,34 +300,447 @@ def pre_process_eval(path, domain, var):
     raw_file_path = f"{path}/evaluation/{driving_model}"
     out_path = f"{path}/combined_eval/{driving_model}"
 
-    rcms = ds_store_remover(os.listdir(raw_file_path))
+    tasks = []
+
+    rcms = catalog.list_dir(raw_file_path)
     for rcm in rcms:
-        eval_mergetime(raw_file_path, rcm, out_path, type="yearmax")
+        tasks.append((
+            f"{driving_model}/{rcm}",
+            eval_mergetime,
+            (raw_file_path, rcm, out_path, var, reducer_types(var))))
+
+    return run_tasks(tasks, f"Evaluation {var}")
+
+
+def outdated(outfiles, infiles, params):
+    '''the outfiles, a dict of outfile keyed by e.g. type or city, that
+    aren't up to date with infiles and params in the build manifest.'''
+
+    if config["force"]:
+        return outfiles
+
+    todo = {}
+    for key, outfile in outfiles.items():
+        if build_manifest.up_to_date(
+                outfile, infiles, {**params, "key": key}):
+            print(f"Up to date: {outfile}")
+        else:
+            todo[key] = outfile
+
+    return todo
+
+
+def record_built(outfiles, infiles, params):
+    '''records the outfiles that were written in the build manifest.'''
+
+    for key, outfile in outfiles.items():
+        if os.path.exists(outfile):
+            build_manifest.record_build(
+                outfile, infiles, {**params, "key": key})
+
+
+def reducer_types(var):
+    '''yearly reducers to compute for a variable, either from the reducers
+    option or the defaults of yearmax, plus yearsum for precipitation.'''
+
+    if config["reducers"]:
+        return config["reducers"]
+
+    if var == "pr":
+        return ["yearmax", "yearsum"]
+
+    return ["yearmax"]
+
+
+def list_nc_files(path):
+    '''sorted list of the netcdf files in a directory.'''
+
+    return [file["name"] for file in catalog.find(path)
+            if file["name"].endswith(".nc")]
+
+
+def dataset_file_name(path):
+    '''the CORDEX file name of the data in a directory up to its date range,
+    with the trailing underscore.'''
+
+    return f"{catalog.find(path)[0]['dataset']}_"
+
+
+def open_mergetime(infiles):
+    '''opens files as one data set lazily concatenated along time, the
+    in-process equivalent of cdo -mergetime.'''
+
+    data_set = xr.open_mfdataset(
+        infiles,
+        combine="nested",
+        concat_dim="time",
+        data_vars="minimal",
+        coords="minimal",
+        compat="override")
+
+    data_set = data_set.sortby("time")
+
+    # historical and rcp85 files can overlap at the join, keep the first
+    _, index = np.unique(data_set["time"].values, return_index=True)
+    data_set = data_set.isel(time=index)
+
+    return data_set
+
+
+def reduced_attrs(data_array, type):
+    '''attributes of data_array reduced to yearly values with type.'''
+
+    attrs = data_array.attrs.copy()
+
+    if type.startswith("yeargt"):
+        threshold = float(type[len("yeargt"):])
+        attrs["units"] = "1"
+        attrs["long_name"] = (f"Number of time steps with {data_array.name} "
+                              f"above {threshold}")
+
+    return attrs
+
+
+def reduce_years(data_array, type):
+    '''reduces a data array to yearly values, type is yearmax, yearmin,
+    yearmean, yearsum or yeargt<threshold> for the number of time steps in
+    each year above threshold.'''
+
+    attrs = reduced_attrs(data_array, type)
+
+    if type.startswith("yeargt"):
+        threshold = float(type[len("yeargt"):])
+        data_array = (data_array > threshold).where(data_array.notnull())
+        operation = "sum"
+    else:
+        operation = type[len("year"):]
+
+    if operation not in ["max", "min", "mean", "sum"]:
+        raise ValueError(f"Unknown reducer: {type}")
+
+    years = data_array.groupby("time.year")
+
+    # years without values stay missing, as with cdo, rather than summing
+    # to 0
+    if operation == "sum":
+        data_array = years.sum("time", min_count=1)
+    else:
+        data_array = getattr(years, operation)("time")
+    data_array.attrs = attrs
+
+    return data_array
 
-        if var == "pr":
-            eval_mergetime(raw_file_path, rcm, out_path, type="yearsum")
 
+def year_data_set(data_set, var, type, data_array, time, time_bnds,
+                  bnds_dim):
+    '''data set of the yearly values of var in data_array, with the
+    coordinates and attributes of data_set.'''
 
-def eval_mergetime(path, rcm, out_path, type):
+    year_set = data_set.drop_dims("time")
+    year_set[var] = data_array
+    year_set = year_set.assign_coords(time=time)
+    year_set["time_bnds"] = (("time", bnds_dim), time_bnds)
+
+    year_set["time"].attrs = data_set["time"].attrs
+    year_set["time"].attrs["bounds"] = "time_bnds"
+    year_set["time"].encoding = {
+        key: value for key, value in data_set["time"].encoding.items()
+        if key in ["units", "calendar"]}
+
+    year_set.attrs = data_set.attrs.copy()
+    year_set.attrs["history"] = (f"{type} of {var} computed with xarray\n"
+                                 f"{data_set.attrs.get('history', '')}")
+
+    return year_set
+
+
+def yearly_reduce(data_set, var, types):
+    '''reduces a data set to yearly values of var for each of types, returns
+    a dict of yearly data sets keyed by type.'''
+
+    # date each year by its last time step, as cdo does
+    years = data_set["time"].dt.year.values
+    first = np.unique(years, return_index=True)[1]
+    last = np.append(first[1:], len(years)) - 1
+    time = data_set["time"].values[last]
+
+    if "time_bnds" in data_set:
+        time_bnds = data_set["time_bnds"].values
+        time_bnds = np.stack([time_bnds[first, 0], time_bnds[last, -1]], 1)
+        bnds_dim = data_set["time_bnds"].dims[-1]
+    else:
+        time_bnds = np.stack([data_set["time"].values[first], time], 1)
+        bnds_dim = "bnds"
+
+    year_sets = {}
+
+    for type in types:
+        data_array = reduce_years(data_set[var], type).rename(year="time")
+        year_sets[type] = year_data_set(
+            data_set, var, type, data_array, time, time_bnds, bnds_dim)
+
+    return year_sets
+
+
+def write_yearly(infiles, var, outfiles):
+    '''merges infiles along time and writes each yearly reduction of var in
+    outfiles, a dict of outfile keyed by type, from a single read of the
+    input.'''
+
+    for type, outfile in outfiles.items():
+        print(f"Reducing {len(infiles)} files to {type}: {outfile}")
+
+    data_set = open_mergetime(infiles)
+    year_sets = yearly_reduce(data_set, var, list(outfiles))
+
+    # one compute for all outputs so the input is only read once
+    xr.save_mfdataset(
+        [netcdf_encoding.apply(year_sets[type], "yearly")
+         for type in outfiles],
+        [outfiles[type] for type in outfiles])
+
+    data_set.close()
+
+
+def accumulate(accumulators, block, types):
+    '''adds a block of time steps, all in the same year, to the running
+    accumulators of that year for each of types. accumulators is a dict
+    keyed by type plus the count of valid values, None for a new year.'''
+
+    block = block.astype("float64")
+    valid = ~np.isnan(block)
+
+    values = {"count": valid.sum(axis=0)}
+
+    for type in types:
+        if type == "yearmax":
+            values[type] = np.fmax.reduce(block, axis=0)
+        elif type == "yearmin":
+            values[type] = np.fmin.reduce(block, axis=0)
+        elif type in ["yearsum", "yearmean"]:
+            values[type] = np.where(valid, block, 0).sum(axis=0)
+        elif type.startswith("yeargt"):
+            threshold = float(type[len("yeargt"):])
+            values[type] = (block > threshold).sum(axis=0)
+        else:
+            raise ValueError(f"Unknown reducer: {type}")
+
+    if accumulators is None:
+        return values
+
+    for key, value in values.items():
+        if key == "yearmax":
+            accumulators[key] = np.fmax(accumulators[key], value)
+        elif key == "yearmin":
+            accumulators[key] = np.fmin(accumulators[key], value)
+        else:
+            accumulators[key] = accumulators[key] + value
+
+    return accumulators
+
+
+def year_fields(accumulators, types):
+    '''the yearly value of each of types from a closed year's accumulators,
+    missing where the year had no valid values.'''
+
+    count = accumulators["count"]
+
+    fields = {}
+    with np.errstate(divide="ignore", invalid="ignore"):
+        for type in types:
+            field = accumulators[type].astype("float64")
+            if type == "yearmean":
+                field = field / count
+            field[count == 0] = np.nan
+            fields[type] = field
+
+    return fields
+
+
+def python_dates(values):
+    '''datetime64 values as python datetimes, cftime dates are unchanged.'''
+
+    if np.issubdtype(values.dtype, np.datetime64):
+        return values.astype("datetime64[us]").astype(object)
+
+    return values
+
+
+def append_year(outfile, var, year_set):
+    '''appends the single year of year_set to outfile, a file written from
+    an earlier year with an unlimited time dimension.'''
+
+    with netCDF4.Dataset(outfile, "a") as nc:
+        time = nc.variables["time"]
+        calendar = getattr(time, "calendar", "standard")
+        n = len(time)
+
+        time[n] = netCDF4.date2num(
+            python_dates(year_set["time"].values), time.units, calendar)
+        nc.variables["time_bnds"][n] = netCDF4.date2num(
+            python_dates(year_set["time_bnds"].values[0]), time.units,
+            calendar)
+        nc.variables[var][n] = year_set[var].values[0]
+
+
+def write_year(data_set, var, year, accumulators, year_time, outfiles):
+    '''writes a closed year to each of outfiles, a dict of outfile keyed by
+    type, starting the files with the first year written.'''
+
+    fields = year_fields(accumulators, list(outfiles))
+
+    time = np.array([year_time["last"]])
+    time_bnds = np.array([[year_time["lower"], year_time["upper"]]])
+    if "time_bnds" in data_set:
+        bnds_dim = data_set["time_bnds"].dims[-1]
+    else:
+        bnds_dim = "bnds"
+
+    for type, outfile in outfiles.items():
+        field = fields[type]
+        if not type.startswith("yeargt"):
+            field = field.astype(data_set[var].dtype)
+
+        data_array = xr.DataArray(
+            field[np.newaxis],
+            dims=data_set[var].dims,
+            attrs=reduced_attrs(data_set[var], type))
+        year_set = year_data_set(
+            data_set, var, type, data_array, time, time_bnds, bnds_dim)
+
+        if year_time["first_year"]:
+            # float times so later years can be appended at any offset
+            year_set["time"].encoding["dtype"] = "float64"
+            year_set["time_bnds"].encoding["dtype"] = "float64"
+            netcdf_encoding.apply(year_set, "yearly", ["time"])
+            year_set.to_netcdf(outfile, unlimited_dims=["time"])
+        else:
+            append_year(outfile, var, year_set)
+
+    print(f"Wrote year {year} of {var}")
+
+
+def stream_yearly(infiles, var, outfiles):
+    '''the streaming equivalent of write_yearly, for long (e.g. daily)
+    records that don't fit in memory. Walks infiles in time order one file
+    at a time keeping only the running accumulators of the current year, and
+    writes each year to outfiles as soon as it closes, so memory is about one
+    input file whatever the length of the record.'''
+
+    for type, outfile in outfiles.items():
+        print(f"Streaming {len(infiles)} files to {type}: {outfile}")
+
+    types = list(outfiles)
+
+    year = None
+    accumulators = None
+    year_time = {"first_year": True}
+    last_time = None
+
+    for infile in infiles:
+        data_set = xr.open_dataset(infile)
+
+        # historical and rcp85 files can overlap at the join, keep the first
+        if last_time is not None:
+            data_set = data_set.isel(
+                time=data_set["time"].values > last_time)
+        if data_set.sizes["time"] == 0:
+            data_set.close()
+            continue
+
+        block = data_set[var].values
+        time = data_set["time"].values
+        years = data_set["time"].dt.year.values
+        if "time_bnds" in data_set:
+            time_bnds = data_set["time_bnds"].values
+        else:
+            time_bnds = np.stack([time, time], 1)
+
+        for file_year in np.unique(years):
+            rows = np.flatnonzero(years == file_year)
+
+            if year is not None and file_year != year:
+                write_year(data_set, var, year, accumulators, year_time,
+                           outfiles)
+                accumulators = None
+                year_time = {"first_year": False}
+
+            if accumulators is None:
+                year_time["lower"] = time_bnds[rows[0], 0]
+
+            year = file_year
+            accumulators = accumulate(accumulators, block[rows], types)
+
+            # date each year by its last time step, as cdo does
+            year_time["last"] = time[rows[-1]]
+            year_time["upper"] = time_bnds[rows[-1], -1]
+
+        last_time = time[-1]
+
+        # keep the metadata of the last file to write the final year
+        template = data_set.isel(time=[-1]).load()
+        del block
+        data_set.close()
+
+    if accumulators is not None:
+        write_year(template, var, year, accumulators, year_time, outfiles)
+
+
+def cdo_yearly(infiles, outfiles):
+    '''runs the yearly reductions of infiles (a string of paths) to
+    outfiles, a dict of outfile keyed by type, with cdo. The reductions run
+    at the same time.'''
+
+    cmds = []
+    for type, outfile in outfiles.items():
+        if type.startswith("yeargt"):
+            threshold = type[len("yeargt"):]
+            operators = ["mergetime", f"gtc,{threshold}", "yearsum"]
+        else:
+            operators = ["mergetime", type]
+
+        cmds.append(cdo_runner.fuse(
+            operators, [infiles], [outfile],
+            options=netcdf_encoding.cdo_options("yearly")))
+
+    run_cdo(cmds)
+
+
+def eval_mergetime(path, rcm, out_path, var, types):
     '''merge ecvaluation data.'''
     print(f"Path: {path}/{rcm}")
-    file_first = ds_store_remover(os.listdir(f"{path}/{rcm}"))[0]
-    file_last = ds_store_remover(os.listdir(f"{path}/{rcm}"))[-1]
-    file_name = file_first[:-16]
-
-    start_year = file_first[-16:-12]
-    end_year = file_last[-9:-5]
+    files = catalog.find(f"{path}/{rcm}")
+    file_name = f"{files[0]['dataset']}_"
 
-    infiles = f"{path}/{rcm}/*"
-    file_name = f"{file_name}{start_year}-{end_year}_{type}.nc"
+    start_year = files[0]["start_year"]
+    end_year = files[-1]["end_year"]
 
     save_path = f"{out_path}/{rcm}"
     os.makedirs(save_path, exist_ok=True)
-    outfile = f"{save_path}/{file_name}"
 
-    cmd = f"cdo -L -{type} -mergetime {infiles} {outfile}"
-    print(f"Running command: {cmd}")
-    os.system(cmd)
+    outfiles = {}
+    for type in types:
+        save_file = f"{file_name}{start_year}-{end_year}_{type}.nc"
+        outfiles[type] = f"{save_path}/{save_file}"
+
+    infiles = [file["path"] for file in files]
+
+    params = {"operation": "yearly", "var": var,
+              "backend": config["backend"]}
+    outfiles = outdated(outfiles, infiles, params)
+
+    if not outfiles:
+        return
+
+    with journal.atomic_outfiles(outfiles) as temp_files:
+        if config["backend"] == "cdo":
+            cdo_yearly(f"{path}/{rcm}/*", temp_files)
+        elif config["stream"]:
+            stream_yearly(infiles, var, temp_files)
+        else:
+            write_yearly(infiles, var, temp_files)
+
+    record_built(outfiles, infiles, params)
 
 
 def pre_process_rcp85(path, domain, var):
@@ -133,36 +748,102 @@ def pre_process_rcp85(path, domain, var):
 
     os.makedirs(f"{path}/combined_rcp85", exist_ok=True)
 
-    driving_models = ds_store_remover(os.listdir(f"{path}/rcp85"))
+    tasks = []
+
+    driving_models = catalog.list_dir(f"{path}/rcp85")
     for driving_model in driving_models:
-        rcms = ds_store_remover(
-                   os.listdir(
-                       f"{path}/rcp85/{driving_model}"))
+        rcms = catalog.list_dir(f"{path}/rcp85/{driving_model}")
         for rcm in rcms:
+            tasks.append((
+                f"{driving_model}/{rcm}",
+                rcp85_mergetime,
+                (path, var, driving_model, rcm)))
+
+    return run_tasks(tasks, f"Rcp {var}")
+
+
+def rcp85_mergetime(path, var, driving_model, rcm):
+    '''combines the historical and rcp data of a single model'''
+
+    os.makedirs(
+        f"{path}/combined_rcp85/{driving_model}/{rcm}",
+        exist_ok=True)
+
+    file_name = dataset_file_name(f"{path}/rcp85/{driving_model}/{rcm}")
+    infile_hist = f"{path}/historical/{driving_model}/{rcm}"
+    infile_rcp = f"{path}/rcp85/{driving_model}/{rcm}"
+
+    outfiles = {}
+    for type in reducer_types(var):
+        save_file = f"{file_name}1950-2100_{type}.nc"
+        outfile = f"{path}/combined_rcp85/{driving_model}/{rcm}"
+        outfiles[type] = f"{outfile}/{save_file}"
+
+    infiles = [f"{infile_hist}/{file}"
+               for file in list_nc_files(infile_hist)]
+    infiles += [f"{infile_rcp}/{file}"
+                for file in list_nc_files(infile_rcp)]
+
+    params = {"operation": "yearly", "var": var,
+              "backend": config["backend"]}
+    todo = outdated(outfiles, infiles, params)
+
+    with journal.atomic_outfiles(todo) as temp_files:
+        if config["backend"] == "cdo" and todo:
+            cdo_yearly(f"{infile_hist}/* {infile_rcp}/*", temp_files)
+        elif config["stream"] and todo:
+            stream_yearly(infiles, var, temp_files)
+        elif todo:
+            write_yearly(infiles, var, temp_files)
+
+    record_built(todo, infiles, params)
+
+    # the stores of rebuilt files are out of date, whether or not new ones
+    # are written
+    for type in todo:
+        zarr_store.remove_stores(path, driving_model, rcm, type)
+
+    if config["zarr"]:
+        write_stores(path, var, driving_model, rcm, outfiles)
 
-            os.makedirs(
-                f"{path}/combined_rcp85/{driving_model}/{rcm}",
-                exist_ok=True)
-
-            file_name = ds_store_remover(
-                os.listdir(f"{path}/rcp85/{driving_model}/{rcm}"))[0][:-16]
-            save_file = f"{file_name}1950-2100_yearmax.nc"
-            infile_hist = f"{path}/historical/{driving_model}/{rcm}/*"
-            infile_rcp = f"{path}/rcp85/{driving_model}/{rcm}/*"
-            infiles = f"{infile_hist} {infile_rcp}"
-            outfile = f"{path}/combined_rcp85/{driving_model}/{rcm}"
-            outfile = f"{outfile}/{save_file}"
-            cmd = f"cdo -L -yearmax -mergetime {infiles} {outfile}"
-            print(f"Running command: {cmd}")
-            os.system(cmd)
-
-            if var == "pr":
-                save_file = f"{file_name}1950-2100_yearsum.nc"
-                outfile = f"{path}/combined_rcp85/{driving_model}/{rcm}"
-                outfile = f"{outfile}/{save_file}"
-                cmd = f"cdo -L -yearsum -mergetime {infiles} {outfile}"
-                print(f"Running command: {cmd}")
-                os.system(cmd)
+
+def write_stores(path, var, driving_model, rcm, combined_files):
+    '''writes the zarr stores of each layout in config["zarr"] of a model's
+    combined files, a dict of file keyed by type.'''
+
+    params = {"operation": "zarr", "compressor": config["compressor"]}
+
+    for type, combined_file in combined_files.items():
+        stores = {
+            layout: zarr_store.store_file(
+                path, driving_model, rcm, type, layout)
+            for layout in config["zarr"]}
+        stores = outdated(stores, [combined_file], params)
+
+        if not stores:
+            continue
+
+        data_set = xr.open_dataset(combined_file)
+        for layout, store in stores.items():
+            zarr_store.write_store(
+                data_set, var, store, layout, config["compressor"])
+        data_set.close()
+
+        record_built(stores, [combined_file], params)
+
+
+def open_combined(combined_file, path, driving_model, rcm, type, layout):
+    '''opens a model's combined rcp85 file, from its zarr store of layout if
+    there is one up to date with it.'''
+
+    store = zarr_store.find_store(
+        path, driving_model, rcm, type, layout, combined_file)
+
+    if store is not None:
+        print(f"Reading from store: {store}")
+        return zarr_store.open_store(store)
+
+    return xr.open_dataset(combined_file, chunks=open_chunks())
 
 
 def make_ensmean(domain, city, var, path_timeseries_eval, type):
@@ -171,26 +852,18 @@ def make_ensmean(domain, city, var, path_timeseries_eval, type):
     driving_model = "ECMWF-ERAINT"
 
     infiles = []
-    rcms = ds_store_remover(os.listdir(path_timeseries_eval))
+    rcms = catalog.list_dir(path_timeseries_eval)
     rcms = [rcm for rcm in rcms if rcm != "ensmean"]
     for rcm in rcms:
-        files = ds_store_remover(os.listdir(
-            f"{path_timeseries_eval}/{rcm}"))
-
-        files = [file for file in files if type in file]
-        files = [file for file in files if city in file]
+        files = catalog.find(
+            f"{path_timeseries_eval}/{rcm}", type=type, city=city)
 
         print(f"Path: {path}")
         print(f"driving_model: {driving_model}")
         print(f"rcm: {rcm}")
         print(f"city: {city}")
 
-        file = files[0]
-        file = f"{path_timeseries_eval}/{rcm}/{file}"
-
-        infiles.append(file)
-
-    infiles = " ".join(infiles)
+        infiles.append(files[0]["path"])
 
     out_path = f"{path_timeseries_eval}/ensmean"
 
@@ -199,9 +872,18 @@ def make_ensmean(domain, city, var, path_timeseries_eval, type):
 
     outfile = f"{out_path}/{outfile}"
 
-    cmd = f"cdo -L -ensmean {infiles} {outfile}"
-    print(f"Running command: {cmd}")
-    os.system(cmd)
+    params = {"operation": "ensmean"}
+    outfiles = outdated({city: outfile}, infiles, params)
+
+    if not outfiles:
+        return
+
+    with journal.atomic_outfiles(outfiles) as temp_files:
+        run_cdo([cdo_runner.fuse(
+            ["ensmean"], infiles, [temp_files[city]],
+            options=netcdf_encoding.cdo_options("timeseries"))])
+
+    record_built(outfiles, infiles, params)
 
 
 def pre_process_eval_ensmean(path, domain, var, cities_lat_lon):
@@ -212,13 +894,141 @@ def pre_process_eval_ensmean(path, domain, var, cities_lat_lon):
 
     os.makedirs(path_ensmean, exist_ok=True)
 
-    for city in cities_lat_lon[domain]:
+    tasks = []
+
+    for type in reducer_types(var):
+        if config["backend"] == "cdo":
+            for city in cities_lat_lon[domain]:
+                tasks.append((
+                    f"ensmean/{city}/{type}",
+                    make_ensmean,
+                    (domain, city, var, path_timeseries_eval, type)))
+        else:
+            tasks.append((
+                f"ensmean/{type}",
+                make_ensmeans,
+                (domain, var, path_timeseries_eval, type,
+                 cities_lat_lon[domain])))
+
+    return run_tasks(tasks, f"Evaluation ensmean {var}")
 
-        make_ensmean(domain, city, var, path_timeseries_eval, type="yearmax")
 
-        if var == "pr":
-            make_ensmean(domain, city, var, path_timeseries_eval,
-                         type="yearsum")
+def ensemble_data_set(template, var, stats):
+    '''data set of the ensemble mean, and the spread if config["spread"],
+    in the layout of a member's data set.'''
+
+    missing = stats["count"] == 0
+
+    fields = {var: stats["mean"]}
+    if config["spread"]:
+        fields[f"{var}_min"] = stats["min"]
+        fields[f"{var}_max"] = stats["max"]
+        with np.errstate(invalid="ignore", divide="ignore"):
+            fields[f"{var}_std"] = np.sqrt(stats["m2"] / stats["count"])
+
+    ens_set = template.copy()
+    for name, field in fields.items():
+        field = np.where(missing, np.nan, field)
+        ens_set[name] = (
+            template[var].dims, field.astype(template[var].dtype),
+            template[var].attrs.copy())
+
+    if config["spread"]:
+        for statistic in ["min", "max", "std"]:
+            ens_set[f"{var}_{statistic}"].attrs["long_name"] = (
+                f"Ensemble {statistic} of {var}")
+
+    ens_set.attrs["history"] = (f"ensemble mean of {var} computed with "
+                                f"xarray\n{template.attrs.get('history', '')}")
+
+    return ens_set
+
+
+def make_ensmeans(domain, var, path_timeseries_eval, type, cities):
+    '''makes the ensemble mean timeseries of every city from one pass over
+    the members, adding one member at a time to running statistics. The
+    members are aligned on the years they all cover.'''
+
+    driving_model = "ECMWF-ERAINT"
+
+    rcms = catalog.list_dir(path_timeseries_eval)
+    rcms = [rcm for rcm in rcms if rcm != "ensmean"]
+
+    # the file of each member, keyed by city and rcm
+    member_files = {city: {} for city in cities}
+    for rcm in rcms:
+        for file in catalog.find(f"{path_timeseries_eval}/{rcm}", type=type):
+            if file["city"] in member_files:
+                member_files[file["city"]][rcm] = file
+
+    outfiles = {}
+    for city in cities:
+        if not member_files[city]:
+            continue
+
+        outfile = f"{var}_{domain}_{driving_model}_evaluation_ensmean_{type}"
+        outfile = f"{outfile}_{city}.nc"
+        outfiles[city] = f"{path_timeseries_eval}/ensmean/{outfile}"
+
+    params = {"operation": "ensmean", "var": var,
+              "spread": config["spread"]}
+
+    todo = {}
+    for city, outfile in outfiles.items():
+        infiles = [file["path"] for file in member_files[city].values()]
+        todo.update(outdated({city: outfile}, infiles, params))
+
+    if not todo:
+        return
+
+    # years covered by every member of a city
+    periods = {}
+    for city in todo:
+        files = member_files[city].values()
+        periods[city] = (max(file["start_year"] for file in files),
+                         min(file["end_year"] for file in files))
+
+    stats = {city: None for city in todo}
+    templates = {}
+
+    for rcm in rcms:
+        print(f"Adding ensemble member: {rcm}")
+
+        for city in todo:
+            if rcm not in member_files[city]:
+                continue
+
+            data_set = xr.open_dataset(member_files[city][rcm]["path"])
+
+            years = data_set["time"].dt.year.values
+            data_set = data_set.isel(
+                time=trend_kernel.period_mask(years, periods[city]))
+
+            # the first member's time axis is the ensemble's, as in cdo
+            if city not in templates:
+                templates[city] = data_set.load()
+            elif data_set.sizes["time"] != templates[city].sizes["time"]:
+                raise ValueError(
+                    f"Member {rcm} of {city} doesn't have one value per "
+                    f"year of {periods[city]}")
+
+            stats[city] = ensemble_stats.add_member(
+                stats[city], data_set[var].values)
+
+            data_set.close()
+
+    ens_sets = [netcdf_encoding.apply(
+        ensemble_data_set(templates[city], var, stats[city]), "timeseries")
+        for city in todo]
+
+    print(f"Saving {len(todo)} ensemble means to: "
+          f"{path_timeseries_eval}/ensmean")
+    with journal.atomic_outfiles(todo) as temp_files:
+        xr.save_mfdataset(ens_sets, list(temp_files.values()))
+
+    for city, outfile in todo.items():
+        infiles = [file["path"] for file in member_files[city].values()]
+        record_built({city: outfile}, infiles, params)
 
 
 def pre_process_timeseries(path, domain, var, cities_lat_lon, experiment):
@@ -227,42 +1037,192 @@ def pre_process_timeseries(path, domain, var, cities_lat_lon, experiment):
     os.makedirs(f"{path}/timeseries", exist_ok=True)
 
     if experiment == "rcp85":
-        driving_models = ds_store_remover(os.listdir(f"{path}/combined_rcp85"))
+        driving_models = catalog.list_dir(f"{path}/combined_rcp85")
     elif experiment == "evaluation":
         driving_models = ["ECMWF-ERAINT"]
 
+    tasks = []
+
     for driving_model in driving_models:
-        rcms = ds_store_remover(
-            os.listdir(f"{path}/{experiment}/{driving_model}"))
+        rcms = catalog.list_dir(f"{path}/{experiment}/{driving_model}")
 
         if experiment == "evaluation":
             rcms = [rcm for rcm in rcms if rcm != "ensmean"]
 
         for rcm in rcms:
-            os.makedirs(
-                f"{path}/timeseries/{driving_model}/{rcm}",
-                exist_ok=True)
+            tasks.append((
+                f"{driving_model}/{rcm}",
+                timeseries_model,
+                (path, domain, var, driving_model, rcm, cities_lat_lon,
+                 experiment)))
 
-            print("Searching this dir for file name.")
-            print(f"{path}/{experiment}/{driving_model}/{rcm}")
-            file_name = ds_store_remover(
-                os.listdir(
-                    f"{path}/{experiment}/{driving_model}/{rcm}"))[0][:-16]
+    return run_tasks(tasks, f"Timeseries {var} {experiment}")
 
+
+def timeseries_model(path, domain, var, driving_model, rcm, cities_lat_lon,
+                     experiment):
+    '''makes timeseries data of a single model for each city'''
+
+    os.makedirs(
+        f"{path}/timeseries/{driving_model}/{rcm}",
+        exist_ok=True)
+
+    print("Searching this dir for file name.")
+    print(f"{path}/{experiment}/{driving_model}/{rcm}")
+    file_name = dataset_file_name(
+        f"{path}/{experiment}/{driving_model}/{rcm}")
+
+    # the cdo commands of every city and type of the model run together
+    jobs = []
+
+    for type in reducer_types(var):
+        if config["backend"] == "cdo":
             for city in cities_lat_lon[domain]:
-                pre_process_city_rcp(domain, var, path, driving_model, rcm,
-                                     city, file_name, cities_lat_lon,
-                                     type="yearmax", experiment=experiment)
+                job = pre_process_city_rcp(
+                    domain, var, path, driving_model, rcm, city,
+                    file_name, cities_lat_lon, type=type,
+                    experiment=experiment)
+                if job is not None:
+                    jobs.append(job)
+        else:
+            pre_process_cities(domain, var, path, driving_model, rcm,
+                               file_name, cities_lat_lon, type=type,
+                               experiment=experiment)
+
+    if jobs:
+        run_city_jobs(jobs)
+
+
+def city_data_set(data_set, var, series, city_lat, city_lon):
+    '''makes a single point data set of a city timeseries, in the same
+    layout as the output of cdo -fldmean.'''
+
+    series = series.expand_dims(lat=[city_lat], lon=[city_lon])
+    series = series.transpose("time", "lat", "lon")
+    series = series.astype(data_set[var].dtype)
+    series.attrs = data_set[var].attrs
+
+    city_set = xr.Dataset({var: series})
+    city_set["lat"].attrs = {"standard_name": "latitude",
+                             "units": "degrees_north"}
+    city_set["lon"].attrs = {"standard_name": "longitude",
+                             "units": "degrees_east"}
+
+    if "time_bnds" in data_set:
+        city_set["time_bnds"] = data_set["time_bnds"]
+
+    city_set["time"].attrs = data_set["time"].attrs
+    city_set["time"].encoding = {
+        key: value for key, value in data_set["time"].encoding.items()
+        if key in ["units", "calendar"]}
+    city_set.attrs = data_set.attrs
+
+    return city_set
+
+
+def pre_process_cities(domain, var, path, driving_model, rcm, file_name,
+                       cities_lat_lon, type, experiment):
+    '''makes the timeseries of every city of the domain, and the whole
+    region, from a single read of a model's combined file. The means are
+    weighted by the cell areas of the grid, see spatial_index.py.'''
+
+    if experiment == "rcp85":
+        experiment_ext = "rcp85"
+    elif experiment == "evaluation":
+        experiment_ext = "eval"
 
-                if var == "pr":
-                    pre_process_city_rcp(domain, var, path, driving_model, rcm,
-                                         city, file_name, cities_lat_lon,
-                                         type="yearsum", experiment=experiment)
+    infile_path = f"{path}/combined_{experiment_ext}/{driving_model}/{rcm}"
+    print(f"Path: {infile_path}")
+
+    infile = catalog.find(infile_path, type=type)
+
+    if not infile:
+        print("No such file.")
+        return
+
+    infile = infile[0]
+
+    if experiment == "rcp85":
+        start_year = "1950"
+        end_year = "2100"
+    elif experiment == "evaluation":
+        start_year = infile["start_year"]
+        end_year = infile["end_year"]
+
+    infile = infile["path"]
+
+    outfiles = {}
+    for city in cities_lat_lon[domain]:
+        outfile = f"{path}/timeseries/{driving_model}/{rcm}"
+        save_file = f"{file_name}{start_year}-{end_year}_{type}_{city}.nc"
+        outfiles[city] = f"{outfile}/{save_file}"
+
+    params = {"operation": "region_means", "var": var,
+              "dist": spatial_index.dist, "cities": cities_lat_lon[domain]}
+    outfiles = outdated(outfiles, [infile], params)
+
+    if not outfiles:
+        return
+
+    if experiment == "rcp85":
+        data_set = open_combined(
+            infile, path, driving_model, rcm, type, "series")
+    else:
+        data_set = xr.open_dataset(infile, chunks=open_chunks())
+
+    years = data_set["time"].dt.year
+    data_set = data_set.isel(
+        time=((years >= int(start_year)) & (years <= int(end_year))).values)
+
+    index = spatial_index.load_index(
+        data_set["lat"], data_set["lon"], cities_lat_lon[domain],
+        spatial_index.dist)
+
+    for city in list(outfiles):
+        if city not in index:
+            del outfiles[city]
+            print(f"Domain: {domain}")
+            print(f"City: {city}")
+            print("Error: City not found in data set.")
+
+    # every city and the whole region from one weighted reduction
+    weights = spatial_index.load_weights(data_set, index)
+    means = spatial_index.region_means(
+        data_set[var], index, list(outfiles), weights)
+
+    # on a dask cluster the means are computed together when saving
+    if not config["scheduler"]:
+        means = means.load()
+
+    city_sets = []
+    for city in outfiles:
+        series = means.sel(city=city, drop=True)
+
+        if city == "wr":
+            city_lat = float(data_set["lat"].mean())
+            city_lon = float(data_set["lon"].mean())
+        else:
+            city_lat = cities_lat_lon[domain][city]["lat"]
+            city_lon = cities_lat_lon[domain][city]["lon"]
+
+        city_sets.append(netcdf_encoding.apply(city_data_set(
+            data_set, var, series, city_lat, city_lon), "timeseries"))
+
+    print(f"Saving {len(outfiles)} timeseries to: "
+          f"{path}/timeseries/{driving_model}/{rcm}")
+    with journal.atomic_outfiles(outfiles) as temp_files:
+        xr.save_mfdataset(city_sets, list(temp_files.values()))
+
+    data_set.close()
+
+    record_built(outfiles, [infile], params)
 
 
 def pre_process_city_rcp(domain, var, path, driving_model, rcm, city,
                          file_name, cities_lat_lon, type, experiment):
-    ''''''
+    '''prepares the cdo timeseries of a city from a combined file, returns
+    a job of the commands to run (see run_city_jobs), None if there's
+    nothing to do.'''
 
     if experiment == "rcp85":
         experiment_ext = "rcp85"
@@ -273,9 +1233,8 @@ def pre_process_city_rcp(domain, var, path, driving_model, rcm, city,
 
     print(f"Path: {path}/combined_{experiment_ext}/{driving_model}/{rcm}")
 
-    files = ds_store_remover(
-        os.listdir(f"{path}/combined_{experiment_ext}/{driving_model}/{rcm}"))
-    infile = [file for file in files if type in file]
+    infile = catalog.find(
+        f"{path}/combined_{experiment_ext}/{driving_model}/{rcm}", type=type)
 
     if infile:
 
@@ -283,70 +1242,79 @@ def pre_process_city_rcp(domain, var, path, driving_model, rcm, city,
 
         if experiment == "evaluation":
 
-            start_year = infile[-20:-16]
-            end_year = infile[-15:-11]
+            start_year = infile["start_year"]
+            end_year = infile["end_year"]
 
-        infile_path = f"{path}/combined_{experiment_ext}/{driving_model}/{rcm}"
-        infile = f"{infile_path}/{infile}"
+        infile = infile["path"]
 
         outfile = f"{path}/timeseries/{driving_model}/{rcm}"
         save_file = f"{file_name}{start_year}-{end_year}_{type}_{city}.nc"
         outfile = f"{outfile}/{save_file}"
 
+        params = {"operation": "fldmean", "var": var,
+                  "dist": spatial_index.dist,
+                  "city": cities_lat_lon[domain][city]}
+        if not outdated({city: outfile}, [infile], params):
+            return None
+
+        # the city box is subset within the cdo command, no scratch files
+        operators = [f"selyear,{start_year}/{end_year}"]
+
         if city != "wr":
 
             data_set = xr.open_dataset(infile)
 
-            time_bnds = data_set.time_bnds
-
-            try:
-                data_set = data_set.where(
-                    (cities_lat_lon[domain][city][
-                        "lat"] - dist < data_set.lat) &
-                    (cities_lat_lon[domain][city][
-                        "lat"] + dist > data_set.lat) &
-                    (cities_lat_lon[domain][city][
-                        "lon"] - dist < data_set.lon) &
-                    (cities_lat_lon[domain][city][
-                        "lon"] + dist > data_set.lon),
-                    drop=True)
-
-            except:
+            index = spatial_index.load_index(
+                data_set["lat"], data_set["lon"], cities_lat_lon[domain],
+                spatial_index.dist)
+
+            if city not in index:
                 print(f"Domain: {domain}")
                 print(f"City: {city}")
                 print("Error: City not found in data set.")
-                return
+                data_set.close()
+                return None
 
-            temp_file_path = f"{path}/timeseries/{driving_model}/{rcm}"
-            temp_file = f"{temp_file_path}/temp.nc"
+            operators.append(spatial_index.index_box(index, city))
+            mask_file = spatial_index.mask_file(data_set, var, index, city)
+            operators.append(f"ifthen {mask_file}")
 
-            data_set["time_bnds"] = time_bnds
+            data_set.close()
 
-            data_set.to_netcdf(temp_file)
+        operators.append("fldmean")
 
-            infile = temp_file
+        return {
+            "cmd": cdo_runner.fuse(
+                operators, [infile], [journal.temp_file(outfile)],
+                options=netcdf_encoding.cdo_options("timeseries")),
+            "outfiles": {city: outfile},
+            "infiles": [infile],
+            "params": params,
+        }
+    else:
+        print("No such file.")
+        return None
 
-        temp_file_selyear = "temp.nc"
 
-        operation = f"-selyear,{start_year}/{end_year}"
-        cmd = f"cdo -L {operation} {infile} {temp_file_selyear}"
-        print(f"Running command: {cmd}")
-        os.system(cmd)
+def run_city_jobs(jobs):
+    '''runs the commands of the city jobs of pre_process_city_rcp at the
+    same time, each writing a temporary file. The outputs that were built are
+    renamed into place and recorded, the others removed.'''
 
-        cmd = f"cdo -L -fldmean {temp_file_selyear} {outfile}"
-        print(f"Running command: {cmd}")
-        os.system(cmd)
+    results = cdo_runner.run(
+        [job["cmd"] for job in jobs], limit=config["cdo_jobs"], check=False)
 
-        cmd_rm = f"rm {temp_file_selyear}"
-        print(f"Removing temp file: {temp_file_selyear}")
-        os.system(cmd_rm)
+    for job, job_results in zip(jobs, results):
+        for outfile in job["outfiles"].values():
+            if cdo_runner.succeeded(job_results):
+                os.replace(journal.temp_file(outfile), outfile)
+            else:
+                journal.remove(journal.temp_file(outfile))
 
-        if city != "wr":
-            cmd_rm = f"rm {temp_file}"
-            print(f"Running command: {cmd}")
-            os.system(cmd_rm)
-    else:
-        print("No such file.")
+        if cdo_runner.succeeded(job_results):
+            record_built(job["outfiles"], job["infiles"], job["params"])
+
+    cdo_runner.raise_failures(results)
 
 
 def make_slope_timmean(path, domain, var, driving_model, rcm, type):
@@ -355,9 +1323,7 @@ def make_slope_timmean(path, domain, var, driving_model, rcm, type):
     path_combined_rcp85 = f"{path}/combined_rcp85"
 
     path_rcm = f"{path_combined_rcp85}/{driving_model}/{rcm}"
-    infile = ds_store_remover(os.listdir(path_rcm))
-
-    infile = [file for file in infile if type in file]
+    infile = [file["name"] for file in catalog.find(path_rcm, type=type)]
     print(f"Path: {path_rcm}")
     print(f"Infiles: {infile}")
 
@@ -378,36 +1344,216 @@ def make_slope_timmean(path, domain, var, driving_model, rcm, type):
     outfile_timmean = f"{outfile_timmean}_timmean.nc"
     outfile_timmean = f"{save_dir_timmean}/{outfile_timmean}"
 
-    outfile_intercept = f"{var}_{domain}_{driving_model}_rcp85_{rcm}_{type}"
-    outfile_intercept = f"{outfile_intercept}_intercept.nc"
-    outfile_intercept = f"{save_dir_slope}/{outfile_intercept}"
-
     outfile_slope = f"{var}_{domain}_{driving_model}_rcp85_{rcm}_{type}"
     outfile_slope = f"{outfile_slope}_slope.nc"
     outfile_slope = f"{save_dir_slope}/{outfile_slope}"
 
-    ops_timmean = "-timmean -selyear,1981/2010"
-    cmd_timmean = f"cdo -L {ops_timmean} {infile} {outfile_timmean}"
+    # all are written, even if only one is out of date
+    built = {"timmean": outfile_timmean, "slope": outfile_slope}
+
+    # the statistics of each period, from the same read of the cube
+    statistics = config["statistics"] if config["backend"] != "cdo" else []
+    if statistics:
+        save_dir_stats = f"{path}/stats/{driving_model}/{rcm}"
+        os.makedirs(save_dir_stats, exist_ok=True)
+
+        for start, end in stats_periods:
+            outfile_stats = f"{var}_{domain}_{driving_model}_rcp85_{rcm}"
+            outfile_stats = f"{outfile_stats}_{type}_{start}-{end}_stats.nc"
+            built[f"stats_{start}_{end}"] = (
+                f"{save_dir_stats}/{outfile_stats}")
+
+    params = {"operation": "slope_timmean", "var": var,
+              "backend": config["backend"]}
+    if statistics:
+        params["statistics"] = statistics
+    outfiles = outdated(built, [infile], params)
+
+    if not outfiles:
+        return
+
+    with journal.atomic_outfiles(built) as temp_files:
+        if config["backend"] == "cdo":
+            cdo_slope_timmean(
+                infile, temp_files["timmean"], temp_files["slope"])
+        else:
+            data_set = open_combined(
+                infile, path, driving_model, rcm, type, "map")
+            outfiles_stats = {
+                (start, end): temp_files[f"stats_{start}_{end}"]
+                for start, end in stats_periods if statistics}
+            write_slope_timmean(
+                data_set, var, temp_files["timmean"], temp_files["slope"],
+                outfiles_stats)
+            data_set.close()
+
+    record_built(built, [infile], params)
+
+
+def period_data_set(data_set, var, fields, period):
+    '''makes a data set of 2-D fields (a dict of numpy arrays keyed by
+    variable name) over a period of years of data_set, with a single time
+    step as in the outputs of cdo timmean and trend.'''
+
+    years = data_set["time"].dt.year.values
+    rows = np.flatnonzero(trend_kernel.period_mask(years, period))
+
+    period_set = data_set.drop_dims("time")
+    period_set = period_set.assign_coords(
+        time=data_set["time"].values[rows[-1:]])
+
+    dims = data_set[var].dims
+    for name, field in fields.items():
+        period_set[name] = (dims, field[np.newaxis].astype("float32"))
+        period_set[name].attrs = data_set[var].attrs.copy()
+
+    if "time_bnds" in data_set:
+        time_bnds = data_set["time_bnds"].values
+        bnds_dim = data_set["time_bnds"].dims[-1]
+        period_set["time_bnds"] = (
+            ("time", bnds_dim),
+            [[time_bnds[rows[0], 0], time_bnds[rows[-1], -1]]])
+
+    period_set["time"].attrs = data_set["time"].attrs
+    period_set["time"].encoding = {
+        key: value for key, value in data_set["time"].encoding.items()
+        if key in ["units", "calendar"]}
+    period_set.attrs = data_set.attrs.copy()
+
+    return period_set
+
+
+def add_global_quantiles(data_set):
+    '''stores the global quantiles (at quantile_levels) and the range of each
+    map of data_set in its attributes, so plots can pick colour limits
+    without reading the maps.'''
+
+    for name, data_array in data_set.data_vars.items():
+        if not np.issubdtype(data_array.dtype, np.floating):
+            continue
+
+        values = data_array.values
+        if np.isnan(values).all():
+            continue
+
+        data_array.attrs["quantile_levels"] = np.array(quantile_levels)
+        data_array.attrs["quantiles"] = np.nanquantile(
+            values.astype("float64"), quantile_levels)
+        data_array.attrs["actual_range"] = np.array(
+            [np.nanmin(values), np.nanmax(values)], dtype="float64")
+
+    return data_set
+
+
+def statistic_attrs(var, statistic, period, units):
+    '''long name and units of a statistic of var over a period.'''
+
+    over = f"{var} over {period[0]}-{period[1]}"
+
+    if statistic == "mean":
+        return {"long_name": f"Mean of {over}", "units": units}
+    elif statistic == "std":
+        return {"long_name": f"Standard deviation of {over}",
+                "units": units}
+    elif statistic == "min":
+        return {"long_name": f"Minimum of {over}", "units": units}
+    elif statistic == "max":
+        return {"long_name": f"Maximum of {over}", "units": units}
+    elif statistic.startswith("p"):
+        return {"long_name": f"Percentile {statistic[1:]} of {over}",
+                "units": units}
+    elif statistic.startswith("gt"):
+        return {"long_name": (f"Number of time steps of {over} above "
+                              f"{statistic[2:]}"),
+                "units": "1"}
+
+
+def write_slope_timmean(data_set, var, outfile_timmean, outfile_slope,
+                        outfiles_stats=None):
+    '''writes the 1981-2010 time-mean and the 2000-2100 trend of a combined
+    data set, with the standard error of the slope and the residual variance,
+    from one pass over the data. The same pass gives the statistics of
+    config["statistics"] over each period of outfiles_stats, a dict of
+    outfile keyed by period.'''
+
+    statistics = config["statistics"] if outfiles_stats else []
+
+    print(f"Computing slope and timmean of: {outfile_slope}")
+
+    if config["scheduler"]:
+        # a task per tile of the grid, run on the dask cluster
+        y_dim, x_dim = data_set[var].dims[1:]
+        fit = trend_kernel.slope_timmean_blocks(
+            data_set[var].chunk({y_dim: 32, x_dim: 32}),
+            trend_period=(2000, 2100), timmean_period=(1981, 2010),
+            statistics=statistics)
+        fields = dask.compute(*fit.values())
+        fit = {name: field.values for name, field in zip(fit, fields)}
+    else:
+        fit = trend_kernel.slope_timmean(
+            data_set[var], trend_period=(2000, 2100),
+            timmean_period=(1981, 2010), statistics=statistics)
+
+    timmean_set = period_data_set(
+        data_set, var, {var: fit["timmean"]}, (1981, 2010))
+
+    slope_set = period_data_set(
+        data_set, var,
+        {var: fit["slope"],
+         f"{var}_stderr": fit["stderr"],
+         f"{var}_resvar": fit["resvar"]},
+        (2000, 2100))
+
+    units = data_set[var].attrs.get("units", "")
+    slope_set[var].attrs["long_name"] = f"Trend of {var} (per year)"
+    slope_set[f"{var}_stderr"].attrs["long_name"] = (
+        f"Standard error of the trend of {var} (per year)")
+    slope_set[f"{var}_resvar"].attrs["long_name"] = (
+        f"Residual variance of the trend of {var}")
+    slope_set[f"{var}_resvar"].attrs["units"] = f"({units})2"
+
+    add_global_quantiles(timmean_set)
+    add_global_quantiles(slope_set)
+
+    print(f"Saving timmean to: {outfile_timmean}")
+    netcdf_encoding.apply(timmean_set, "map").to_netcdf(outfile_timmean)
+    print(f"Saving slope to: {outfile_slope}")
+    netcdf_encoding.apply(slope_set, "map").to_netcdf(outfile_slope)
 
-    print(f"Running command: {cmd_timmean}")
-    os.system(cmd_timmean)
+    for period, outfile in (outfiles_stats or {}).items():
+        stats_set = period_data_set(
+            data_set, var,
+            {f"{var}_{statistic}":
+             fit[f"{statistic}_{period[0]}_{period[1]}"]
+             for statistic in statistics},
+            period)
 
-    # hack to allow trend operation to work, permission denied in outfile2
-    # (outfile_slope)
-    cmd_hack = f'echo "" > {outfile_slope}'
-    print(f"Running command: {cmd_hack}")
-    os.system(cmd_hack)
+        for statistic in statistics:
+            stats_set[f"{var}_{statistic}"].attrs.update(statistic_attrs(
+                var, statistic, period, units))
 
-    ops_slope = "-trend -selyear,2000/2100"
-    cmd_slope = (f"cdo -L {ops_slope} {infile} {outfile_intercept} "
-                 f"{outfile_slope}")
+        add_global_quantiles(stats_set)
 
-    print(f"Running command: {cmd_slope}")
-    os.system(cmd_slope)
+        print(f"Saving statistics of {period[0]}-{period[1]} to: {outfile}")
+        netcdf_encoding.apply(stats_set, "map").to_netcdf(outfile)
 
-    cmd_rm_intercept = f"rm {save_dir_slope}/*intercept*nc"
-    print(f"Running command: {cmd_rm_intercept}")
-    os.system(cmd_rm_intercept)
+
+def cdo_slope_timmean(infile, outfile_timmean, outfile_slope):
+    '''makes the 1981-2010 time-mean and the 2000-2100 trend of a combined
+    file with cdo. regres gives the slope of cdo trend without also writing
+    the intercept, which isn't kept.'''
+
+    options = netcdf_encoding.cdo_options("map")
+
+    cmd_timmean = cdo_runner.fuse(
+        ["selyear,1981/2010", "timmean"], [infile], [outfile_timmean],
+        options=options)
+    cmd_slope = cdo_runner.fuse(
+        ["selyear,2000/2100", "regres"], [infile], [outfile_slope],
+        options=options)
+
+    # the time-mean and the trend run at the same time
+    run_cdo([cmd_timmean, cmd_slope])
 
 
 def pre_process_slope_timmean(path, domain, var):
@@ -416,30 +1562,212 @@ def pre_process_slope_timmean(path, domain, var):
 
     path_combined_rcp85 = f"{path}/combined_rcp85"
 
-    driving_models = ds_store_remover(os.listdir(path_combined_rcp85))
+    driving_models = catalog.list_dir(path_combined_rcp85)
+
+    tasks = []
 
     for driving_model in driving_models:
-        rcms = ds_store_remover(
-            os.listdir(f"{path_combined_rcp85}/{driving_model}"))
+        rcms = catalog.list_dir(f"{path_combined_rcp85}/{driving_model}")
         for rcm in rcms:
+            for type in reducer_types(var):
+
+                tasks.append((
+                    f"{driving_model}/{rcm}/{type}",
+                    make_slope_timmean,
+                    (path, domain, var, driving_model, rcm, type)))
+
+    return run_tasks(tasks, f"Slope {var}")
+
+
+def member_files(path, stage, type):
+    '''the file of stage (slope or timmean) and type of every model, a dict
+    of path keyed by driving_model/rcm.'''
+
+    files = {}
+    for driving_model in catalog.list_dir(f"{path}/{stage}"):
+        for rcm in catalog.list_dir(f"{path}/{stage}/{driving_model}"):
+            found = [file for file in catalog.find(
+                f"{path}/{stage}/{driving_model}/{rcm}", type=type)
+                if file["name"].endswith(f"_{stage}.nc")]
+            if found:
+                files[f"{driving_model}/{rcm}"] = found[0]["path"]
+
+    return files
+
+
+def ensemble_grid(files):
+    '''the grid of the ensemble maps of files, a list of paths. None if the
+    models share a grid, the maps are then kept on it, else the 1-D lat and
+    lon of the common grid they are regridded to.'''
+
+    data_sets = [xr.open_dataset(file) for file in files]
+
+    hashes = {spatial_index.grid_hash(data_set["lat"], data_set["lon"])
+              for data_set in data_sets}
+
+    if len(hashes) == 1:
+        grid = None
+    else:
+        grid = regrid.common_grid(data_sets)
+
+    for data_set in data_sets:
+        data_set.close()
+
+    return grid
+
+
+def member_map(file, var, grid):
+    '''the 2-D map of var of a slope or timmean file, regridded to grid
+    (see ensemble_grid) if given.'''
+
+    with xr.open_dataset(file) as data_set:
+        data_array = data_set[var].isel(time=0, drop=True).load()
+
+    if grid is not None:
+        data_array = regrid.regrid(data_array, *grid)
+        data_array.attrs.pop("grid_mapping", None)
+
+    return data_array
+
+
+def ensemble_fields(files, var, grid):
+    '''the ensemble statistics of the maps of var of files, a list of paths,
+    from two passes over the members, see ensemble_stats.py. The maps are
+    2-D, so each is read (and regridded) once and kept for the second pass.
+    Returns a dict of 2-D fields and the map of the first file.'''
+
+    stats = None
+    maps = []
+    for file in files:
+        print(f"Adding ensemble member: {file}")
+        maps.append(member_map(file, var, grid))
+        stats = ensemble_stats.add_member(stats, maps[-1].values)
+
+    # the second pass places each member in the histograms of the cells
+    histogram = ensemble_stats.new_histogram(stats)
+    for data_array in maps:
+        ensemble_stats.add_to_histogram(histogram, data_array.values)
+
+    return ensemble_stats.statistics(stats, histogram), maps[0]
+
+
+def ensemble_data_set_maps(fields, template, var, grid_mapping):
+    '''data set of the ensemble statistics of the slope and timmean maps,
+    fields is a dict of the fields of each stage, on the grid of template, a
+    member's map, with its grid_mapping variable if it has one.'''
+
+    names = {
+        "mean": "Ensemble mean",
+        "std": "Ensemble standard deviation",
+        "median": "Ensemble median",
+        "q25": "Ensemble 25th percentile",
+        "q75": "Ensemble 75th percentile",
+        "iqr": "Ensemble interquartile range",
+        "agreement": "Fraction of models agreeing on the sign",
+    }
+    descriptions = {
+        "slope": f"of the 2000-2100 trend of {var} (per year)",
+        "timmean": f"of the 1981-2010 mean of {var}",
+    }
+
+    ens_set = xr.Dataset(coords=template.coords)
+
+    if grid_mapping is not None:
+        ens_set[grid_mapping.name] = grid_mapping
+
+    for stage, stage_fields in fields.items():
+        for statistic, field in stage_fields.items():
+
+            # the sign agreement is only of the trend
+            if statistic == "agreement" and stage != "slope":
+                continue
+
+            attrs = {key: value for key, value in template.attrs.items()
+                     if key in ["units", "grid_mapping"]}
+            if statistic == "agreement":
+                attrs["units"] = "1"
+            attrs["long_name"] = (
+                f"{names[statistic]} {descriptions[stage]}")
 
-            make_slope_timmean(
-                path,
-                domain,
-                var,
-                driving_model,
-                rcm,
-                type="yearmax")
+            ens_set[f"{stage}_{statistic}"] = (
+                template.dims, field.astype("float32"), attrs)
 
-            if var == "pr":
+    return ens_set
 
-                make_slope_timmean(
-                    path,
-                    domain,
-                    var,
-                    driving_model,
-                    rcm,
-                    type="yearsum")
+
+def make_ensemble(path, domain, var, type):
+    '''makes the ensemble statistics of the slope and timmean maps of all
+    the models of a type, reading one model at a time.'''
+
+    files = {stage: member_files(path, stage, type)
+             for stage in ["slope", "timmean"]}
+    files = {stage: stage_files for stage, stage_files in files.items()
+             if stage_files}
+
+    if not files:
+        print(f"No slope or timmean files of {type} in: {path}")
+        return
+
+    save_dir = f"{path}/ensemble"
+    os.makedirs(save_dir, exist_ok=True)
+
+    outfile = f"{var}_{domain}_rcp85_ensemble_{type}_stats.nc"
+    outfile = f"{save_dir}/{outfile}"
+
+    infiles = [file for stage_files in files.values()
+               for file in stage_files.values()]
+
+    params = {"operation": "ensemble", "var": var,
+              "bins": ensemble_stats.bins}
+    outfiles = outdated({"ensemble": outfile}, infiles, params)
+
+    if not outfiles:
+        return
+
+    grid = ensemble_grid(infiles)
+    if grid is not None:
+        print(f"Regridding the models to a common grid of "
+              f"{len(grid[0])} x {len(grid[1])}")
+
+    fields = {}
+    for stage, stage_files in files.items():
+        fields[stage], template = ensemble_fields(
+            list(stage_files.values()), var, grid)
+
+    # the grid mapping of the models' own grid, e.g. rotated_pole
+    grid_mapping = None
+    if grid is None and "grid_mapping" in template.attrs:
+        with xr.open_dataset(infiles[0]) as member_set:
+            name = template.attrs["grid_mapping"]
+            if name in member_set:
+                grid_mapping = member_set[name].load()
+
+    ens_set = ensemble_data_set_maps(fields, template, var, grid_mapping)
+    add_global_quantiles(ens_set)
+    for stage, stage_files in files.items():
+        ens_set.attrs[f"{stage}_models"] = ", ".join(stage_files)
+
+    print(f"Saving ensemble statistics to: {outfile}")
+    with journal.atomic_outfiles(outfiles) as temp_files:
+        netcdf_encoding.apply(ens_set, "map").to_netcdf(
+            temp_files["ensemble"])
+
+    record_built(outfiles, infiles, params)
+
+
+def pre_process_ensemble(path, domain, var):
+    '''make the ensemble statistics of the slopes and timmeans of all models
+        given a domain and variable, for each type'''
+
+    tasks = []
+
+    for type in reducer_types(var):
+        tasks.append((
+            type,
+            make_ensemble,
+            (path, domain, var, type)))
+
+    return run_tasks(tasks, f"Ensemble {var}")
 
 
 def main(args):
@@ -452,15 +1780,91 @@ def main(args):
         type = 'timeseries'
     elif args['slope']:
         type = 'slope'
+    elif args['ensemble']:
+        type = 'ensemble'
 
     domain = args['--domain']
 
+    if args.get('--backend'):
+        config["backend"] = args['--backend']
+
+    if args.get('--reducers'):
+        config["reducers"] = args['--reducers'].split(",")
+
+    if args.get('--jobs'):
+        config["jobs"] = int(args['--jobs'])
+
+    if args.get('--stream'):
+        config["stream"] = True
+
+    if args.get('--spread'):
+        config["spread"] = True
+
+    if args.get('--zarr'):
+        config["zarr"] = args['--zarr'].split(",")
+
+    if args.get('--statistics'):
+        config["statistics"] = args['--statistics'].split(",")
+        trend_kernel.statistic_names(config["statistics"], stats_periods)
+
+    if args.get('--compressor'):
+        config["compressor"] = args['--compressor']
+
+    if args.get('--cdo_jobs'):
+        config["cdo_jobs"] = int(args['--cdo_jobs'])
+
+    if args.get('--encoding'):
+        config["encoding"] = args['--encoding']
+        netcdf_encoding.policy_file = config["encoding"]
+
+    if args.get('--force'):
+        config["force"] = True
+
+    if args.get('--resume'):
+        config["resume"] = True
+
+    if args.get('--scheduler'):
+        config["scheduler"] = args['--scheduler']
+
+        # the cluster runs the work of each model, run them one at a time
+        config["jobs"] = 1
+
+        if args.get('--workers'):
+            workers = int(args['--workers'])
+        else:
+            workers = None
+
+        client = start_client(
+            config["scheduler"], workers, args.get('--memory_limit', "auto"))
+
+    if args.get('--time_frequency'):
+        time_frequency = args['--time_frequency']
+    else:
+        time_frequency = "mon"
+
+    data_path = f"{cordex_path}/{time_frequency}"
+
     if '--var_option' in args:
         var_option = args['--var_option']
     else:
         var_option = None
 
-    pre_process_data(path, domain, type, var_option)
+    config["journal"] = (
+        f"{type}_{time_frequency}_{domain}_{var_option or 'all'}")
+    journal.start(config["journal"], config["resume"])
+
+    catalog.refresh(f"{data_path}/{domain}")
+
+    failures = pre_process_data(data_path, domain, type, var_option)
+
+    if config["scheduler"]:
+        client.close()
+
+    if failures:
+        print(f"{len(failures)} tasks failed:")
+        for key, _ in failures:
+            print(f"    {key}")
+        sys.exit(1)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,235 @@
+"""
+File: regrid.py
+Author: riley cooper
+Email: rwr.cooper@gmail.com
+Description:
+    Regridding of model fields to a common regular lat/lon grid, so models
+    on different grids (rlat/rlon, x/y) can be combined into ensemble maps.
+    The remapping from a source grid to a target grid is a sparse matrix,
+    made once and cached in regrid_path by the hash of the source grid (see
+    spatial_index.grid_hash) and of the target grid. It is a linear
+    interpolation on a Delaunay triangulation of the source cell centres in
+    a gnomonic projection about the centre of the grid, so it works for any
+    curvilinear grid. A whole (time, y, x) stack is remapped with a single
+    sparse matrix product, missing values are left out and the weights of
+    the rest renormalised.
+"""
+
+
+import hashlib
+import os
+import numpy as np
+import scipy.sparse
+import scipy.spatial
+import xarray as xr
+import journal
+import spatial_index
+
+
+regrid_path = "data-link/cordex-data/regrid"
+
+
+# spacing in degrees of the common grid, as the CORDEX -44i grids
+resolution = 0.5
+
+
+# longest side of a triangle of the triangulation, relative to the median
+# over the grid, beyond which it isn't part of the grid
+max_side = 2
+
+
+# least total weight of the valid source cells for a target cell to have
+# a value, so a target isn't made from a single corner of its triangle
+min_weight = 0.5
+
+
+def unit_vectors(lat, lon):
+    '''(n, 3) unit vectors of points given in degrees.'''
+
+    lat = np.deg2rad(np.ravel(lat))
+    lon = np.deg2rad(np.ravel(lon))
+
+    return np.column_stack([np.cos(lat) * np.cos(lon),
+                            np.cos(lat) * np.sin(lon),
+                            np.sin(lat)])
+
+
+def unwrap_lon(lon, centre):
+    '''longitudes within 180 degrees of centre, for grids over the
+    dateline.'''
+
+    return centre + (np.asarray(lon) - centre + 180) % 360 - 180
+
+
+def common_grid(data_sets, resolution=resolution):
+    '''1-D lat and lon of the regular grid covering every one of data_sets,
+    with cells centred on multiples of resolution.'''
+
+    vectors = np.concatenate([
+        unit_vectors(data_set["lat"].values, data_set["lon"].values)
+        for data_set in data_sets])
+    x, y, _ = vectors.mean(axis=0)
+    centre = np.rad2deg(np.arctan2(y, x))
+
+    lats = np.concatenate(
+        [np.ravel(data_set["lat"].values) for data_set in data_sets])
+    lons = np.concatenate(
+        [np.ravel(unwrap_lon(data_set["lon"].values, centre))
+         for data_set in data_sets])
+
+    def axis(values):
+        start = np.floor(np.nanmin(values) / resolution) * resolution
+        end = np.ceil(np.nanmax(values) / resolution) * resolution
+        return np.round(np.arange(start, end + resolution / 2, resolution),
+                        6)
+
+    return axis(lats), axis(lons)
+
+
+def grid_key(lat, lon):
+    '''hash of a regular grid's 1-D lat and lon.'''
+
+    sha = hashlib.sha1()
+    for coord in [lat, lon]:
+        sha.update(np.ascontiguousarray(coord, dtype="float64").tobytes())
+
+    return sha.hexdigest()[:16]
+
+
+def source_points(lat, lon):
+    '''2-D lat and lon values of a source grid, whose coords are 2-D or the
+    1-D axes of a regular grid.'''
+
+    if lat.ndim == 1:
+        return np.meshgrid(lat.values, lon.values, indexing="ij")
+
+    return lat.values, lon.values
+
+
+def gnomonic(vectors, centre):
+    '''(n, 2) gnomonic projection of unit vectors about centre, a unit
+    vector. Points on the far side of the sphere are nan.'''
+
+    pole = np.array([0, 0, 1]) if abs(centre[2]) < 0.9 else np.array(
+        [1, 0, 0])
+    east = np.cross(pole, centre)
+    east = east / np.linalg.norm(east)
+    north = np.cross(centre, east)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        depth = vectors @ centre
+        points = np.column_stack([vectors @ east, vectors @ north])
+        points = points / depth[:, np.newaxis]
+
+    points[depth <= 0] = np.nan
+
+    return points
+
+
+def remap_matrix(src_lat, src_lon, lat, lon):
+    '''sparse (target cells, source cells) matrix of the linear
+    interpolation from a source grid of 2-D lat and lon to the regular grid
+    of 1-D lat and lon. Target cells outside the source grid have no
+    weights.'''
+
+    src = unit_vectors(src_lat, src_lon)
+    target_lat, target_lon = np.meshgrid(lat, lon, indexing="ij")
+    target = unit_vectors(target_lat, target_lon)
+
+    centre = src.mean(axis=0)
+    centre = centre / np.linalg.norm(centre)
+
+    triangulation = scipy.spatial.Delaunay(gnomonic(src, centre))
+
+    points = gnomonic(target, centre)
+    simplex = np.full(len(points), -1)
+    finite = np.isfinite(points).all(axis=1)
+    simplex[finite] = triangulation.find_simplex(points[finite])
+
+    # the hull of the grid's curved edges is filled by long thin triangles,
+    # targets in them are outside the grid
+    corners = triangulation.points[triangulation.simplices]
+    sides = np.linalg.norm(corners - np.roll(corners, 1, axis=1), axis=2)
+    longest = sides.max(axis=1)
+    outside = longest > max_side * np.median(longest)
+    simplex[(simplex >= 0) & outside[simplex]] = -1
+
+    inside = np.flatnonzero(simplex >= 0)
+
+    # barycentric coordinates of each target in its triangle
+    transform = triangulation.transform[simplex[inside]]
+    coords = np.einsum("nij,nj->ni", transform[:, :2],
+                       points[inside] - transform[:, 2])
+    weights = np.column_stack([coords, 1 - coords.sum(axis=1)])
+
+    rows = np.repeat(inside, 3)
+    cols = triangulation.simplices[simplex[inside]].ravel()
+
+    return scipy.sparse.csr_matrix(
+        (weights.ravel(), (rows, cols)), shape=(len(target), len(src)))
+
+
+def load_matrix(src_lat, src_lon, lat, lon):
+    '''remap matrix from the grid of src_lat and src_lon (coords of a data
+    set) to the regular grid of lat and lon from disk, making and saving it
+    first if needed.'''
+
+    os.makedirs(regrid_path, exist_ok=True)
+    file = (f"{regrid_path}/{spatial_index.grid_hash(src_lat, src_lon)}_"
+            f"{grid_key(lat, lon)}.npz")
+
+    if os.path.exists(file):
+        return scipy.sparse.load_npz(file)
+
+    print(f"Making remap matrix: {file}")
+
+    matrix = remap_matrix(*source_points(src_lat, src_lon), lat, lon)
+
+    def write(temp):
+        with open(temp, "wb") as writer:
+            scipy.sparse.save_npz(writer, matrix)
+
+    journal.atomic_write(file, write)
+
+    return matrix
+
+
+def regrid(data_array, lat, lon):
+    '''remaps a data array with lat and lon coords, and any other dims such
+    as time, to the regular grid of 1-D lat and lon.'''
+
+    matrix = load_matrix(data_array["lat"], data_array["lon"], lat, lon)
+
+    if data_array["lat"].ndim == 1:
+        spatial_dims = [data_array["lat"].dims[0], data_array["lon"].dims[0]]
+    else:
+        spatial_dims = list(data_array["lat"].dims)
+
+    other_dims = [dim for dim in data_array.dims if dim not in spatial_dims]
+    data_array = data_array.transpose(*other_dims, *spatial_dims)
+
+    shape = [data_array.sizes[dim] for dim in other_dims]
+    values = data_array.values.reshape(int(np.prod(shape)), -1)
+
+    # one product for the whole stack, renormalised over valid cells
+    valid = ~np.isnan(values)
+    total = matrix @ np.where(valid, values, 0).T
+    norm = matrix @ valid.T.astype("float64")
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        remapped = np.where(norm >= min_weight, total / norm, np.nan)
+
+    remapped = remapped.T.reshape(shape + [len(lat), len(lon)])
+
+    coords = {dim: data_array[dim] for dim in other_dims
+              if dim in data_array.coords}
+    coords.update({
+        "lat": ("lat", lat, {"standard_name": "latitude",
+                             "units": "degrees_north"}),
+        "lon": ("lon", lon, {"standard_name": "longitude",
+                             "units": "degrees_east"}),
+    })
+
+    return xr.DataArray(remapped, dims=other_dims + ["lat", "lon"],
+                        coords=coords, attrs=data_array.attrs,
+                        name=data_array.name)
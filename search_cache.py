@@ -0,0 +1,241 @@
+"""
+File: search_cache.py
+Author: riley cooper
+Email: rwr.cooper@gmail.com
+Description:
+    Cache on disk of the ESGF searches of model_downloader.py and
+    table_maker.py: the hit count and facet counts of a search, the json of
+    its data set results and the files of a data set. An entry is keyed by
+    the kind of search and its constraints, normalized so the order of the
+    constraints and of the comma separated values of each doesn't matter,
+    and unset (None) constraints are left out. Entries are json files in
+    cache_path, reused for ttl seconds after they were fetched, after which
+    the search is run again and the entry replaced. With offline set, only
+    the cache is used, whatever the age of its entries, and a search that
+    isn't in it is an error, so runs against a recorded cache need no
+    network. The connection to ESGF, shared by the searches of a run, is
+    only made when a search has to be run. The data sets of a search are
+    fetched in pages of page_size, pages at a time, rather than one batch
+    after another.
+"""
+
+
+import hashlib
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+import journal
+
+
+cache_path = "data-link/cordex-data/manifest/search"
+
+
+# index node the searches are sent to
+search_url = 'https://esgf-node.llnl.gov/esg-search'
+# search_url = 'https://esgf-data.dkrz.de/search/esgf-dkrz/'
+
+
+# data sets in a page of a search
+page_size = 1000
+
+
+# ttl in seconds of the entries, offline and the pages of a search fetched at
+# once, set from the command line by the scripts using the cache
+config = {
+    "ttl": 24 * 3600,
+    "offline": False,
+    "pages": 4,
+}
+
+
+# the connection to ESGF, made on first use
+state = {"conn": None}
+
+
+def connect():
+    '''the connection to ESGF, connecting on the first call.'''
+
+    if state["conn"] is None:
+        from pyesgf.search import SearchConnection
+
+        print("Creating connection.")
+        state["conn"] = SearchConnection(search_url, distrib=True)
+
+    return state["conn"]
+
+
+def normalize(constraints):
+    '''constraints with the unset ones left out and the values of each as a
+    sorted list.'''
+
+    normalized = {}
+    for name, value in constraints.items():
+        if value is None:
+            continue
+        if isinstance(value, str):
+            value = value.split(",")
+        elif not isinstance(value, (list, tuple)):
+            value = [value]
+        normalized[name] = sorted({str(item).strip() for item in value})
+
+    return normalized
+
+
+def entry_file(kind, constraints):
+    '''path of the cache entry of a search.'''
+
+    key = json.dumps([kind, normalize(constraints)], sort_keys=True)
+    key = hashlib.sha1(key.encode()).hexdigest()
+
+    return f"{cache_path}/{kind}_{key}.json"
+
+
+def read(kind, constraints):
+    '''the cache entry of a search, None if there isn't one.'''
+
+    try:
+        with open(entry_file(kind, constraints)) as reader:
+            return json.load(reader)
+    except (OSError, ValueError):
+        return None
+
+
+def write(kind, constraints, data):
+    '''saves the result of a search, data of json types, as its cache
+    entry.'''
+
+    file = entry_file(kind, constraints)
+    os.makedirs(os.path.dirname(file), exist_ok=True)
+
+    entry = {
+        "kind": kind,
+        "constraints": normalize(constraints),
+        "time": time.time(),
+        "data": data,
+    }
+
+    def write_entry(temp):
+        with open(temp, "w") as writer:
+            json.dump(entry, writer)
+
+    journal.atomic_write(file, write_entry)
+
+
+def cached(kind, constraints, fetch):
+    '''the result of a search, from the cache if it has an entry younger than
+    the ttl (of any age offline), otherwise from fetch, a function running
+    the search, whose result is saved to the cache.'''
+
+    entry = read(kind, constraints)
+
+    if config["offline"]:
+        if entry is None:
+            raise LookupError(f"No cached {kind} search of "
+                              f"{normalize(constraints)} to use offline")
+        return entry["data"]
+
+    if entry is not None and time.time() - entry["time"] < config["ttl"]:
+        return entry["data"]
+
+    print(f"Searching ESGF ({kind}): {normalize(constraints)}")
+    data = fetch()
+    write(kind, constraints, data)
+
+    return data
+
+
+def counts(constraints):
+    '''the hit count and facet counts of a search, fetched together as ESGF
+    returns them.'''
+
+    def fetch():
+        ctx = connect().new_context(**constraints)
+        return {"hit_count": ctx.hit_count, "facet_counts": ctx.facet_counts}
+
+    return cached("counts", constraints, fetch)
+
+
+def hit_count(constraints):
+    '''the number of data sets matching constraints.'''
+
+    return counts(constraints)["hit_count"]
+
+
+def facet_counts(constraints):
+    '''the counts of the values of each facet of the data sets matching
+    constraints.'''
+
+    return counts(constraints)["facet_counts"]
+
+
+def query(constraints, fields=None):
+    '''the query of a data set search, as (name, value) pairs, a value of a
+    constraint per pair. fields limits the json of the data sets to those
+    fields.'''
+
+    items = [("type", "Dataset")]
+    if fields:
+        items.append(("fields", ",".join(fields)))
+
+    for name, values in normalize(constraints).items():
+        items.extend((name, value) for value in values)
+
+    return items
+
+
+def page(constraints, offset, fields=None):
+    '''the page of page_size data sets of a search from offset, the response
+    of ESGF with the hit count (numFound) and the json of the data sets
+    (docs).'''
+
+    response = connect().send_search(
+        query(constraints, fields), limit=page_size, offset=offset)
+
+    return response["response"]
+
+
+def search(constraints, fields=None):
+    '''the json of each data set matching constraints, with only fields if
+    given. The first page gives the hit count, the rest are fetched pages at
+    a time.'''
+
+    def fetch():
+        first = page(constraints, 0, fields)
+        offsets = range(page_size, first["numFound"], page_size)
+
+        with ThreadPoolExecutor(max_workers=config["pages"]) as executor:
+            pages = list(executor.map(
+                lambda offset: page(constraints, offset, fields),
+                offsets))
+
+        # data sets published between pages can shift one into the next
+        results = {}
+        for response in [first] + pages:
+            for doc in response["docs"]:
+                results.setdefault(doc["id"], doc)
+
+        print(f"Data sets found: {len(results)} of {first['numFound']}")
+
+        return list(results.values())
+
+    return cached("search", dict(constraints, fields=fields), fetch)
+
+
+def files(dataset_id):
+    '''the files of a data set, as dicts of their download_url, filename,
+    size, checksum and checksum_type.'''
+
+    def fetch():
+        from pyesgf.search.context import FileSearchContext
+
+        ctx = connect().new_context(FileSearchContext, dataset_id=dataset_id)
+        return [{
+            "download_url": file.download_url,
+            "filename": file.filename,
+            "size": file.size,
+            "checksum": file.checksum,
+            "checksum_type": file.checksum_type,
+        } for file in ctx.search(ignore_facet_check=True)]
+
+    return cached("files", {"dataset_id": dataset_id}, fetch)
@@ -4,14 +4,19 @@ File: multi_model_slope_analysis.py
 Author: riley cooper
 Email: rwr.cooper@gmail.com
 Description:
-    Makes slope plots as seen in Gitlab issues.
+    Makes slope plots as seen in Gitlab issues. The slope and timmean maps of
+    a model are read from the slope and timmean files of pre-processor.py.
+    Directories are looked up in the catalog of the data tree, see
+    catalog.py. The ensemble option adds a row of the ensemble mean of the
+    models, regridded to a common lat/lon grid, see regrid.py.
 
 Usage:
-    slope_plots_cordex.py make-plots -d <domain> [-v <var_option]
+    slope_plots_cordex.py make-plots -d <domain> [-v <var_option] [--ensemble]
 
 Options:
     -d <domain>, --domain=<domain>
     -v <var_option>, --var_option=<var_option>
+    --ensemble  add the ensemble mean of the models
 
     -h, --help
     --option=<n>
@@ -26,7 +31,8 @@ import matplotlib.colors as colors
 import matplotlib.cm as cm
 import cartopy.crs as ccrs
 import os
-from ds_store_remover import ds_store_remover
+import catalog
+import regrid
 
 
 '''
@@ -148,6 +154,12 @@ def plot_model_type(domain, data_sets, cmap, axes, add, var, vmin, vmax, fig,
             xvar = "x"
             yvar = "y"
 
+        # ensemble maps are on a regular lat/lon grid
+        if "lat" in ds.dims:
+            transform = ccrs.PlateCarree()
+        else:
+            transform = rotated_pole_c
+
         print("Trying to plot:")
         print(f"Model: {model}")
 
@@ -160,13 +172,13 @@ def plot_model_type(domain, data_sets, cmap, axes, add, var, vmin, vmax, fig,
                 ds.coords["rlon"] = (
                     ((ds.coords["rlon"] + 180) % 360) - 180)
 
-        if domain == "SAM-44":
+        if domain == "SAM-44" and "rlon" in ds.coords:
             ds.coords["rlon"] = ds.coords["rlon"] % 360
 
         ds = ds.data_vars[var]
 
         ds.plot(
-            ax=ax, transform=rotated_pole_c, vmin=vmin, vmax=vmax, cmap=cmap,
+            ax=ax, transform=transform, vmin=vmin, vmax=vmax, cmap=cmap,
             add_colorbar=False)  # ), x=xvar, y=yvar)
 
         print("Plot succesful")
@@ -200,14 +212,64 @@ def plot_model_type(domain, data_sets, cmap, axes, add, var, vmin, vmax, fig,
                          cax=cbar_ax, label=label)
 
 
-def make_plot(domain, var_option):
+def rescale(data_array, factor):
+    '''data_array divided by factor, with the quantiles and range stored with
+    it by the slope stage divided by the same.'''
+
+    scaled = data_array / factor
+    scaled.attrs = dict(data_array.attrs)
+
+    for attr in ["quantiles", "actual_range"]:
+        if attr in scaled.attrs:
+            scaled.attrs[attr] = np.asarray(scaled.attrs[attr]) / factor
+
+    return scaled
+
+
+def map_quantile(data_array, q):
+    '''the q quantile of a map, from the global quantiles the slope stage of
+    pre-processor.py stores with it when it has q, else computed.'''
+
+    levels = np.atleast_1d(data_array.attrs.get("quantile_levels", []))
+    match = np.flatnonzero(np.isclose(levels, q))
+
+    if match.size:
+        return np.atleast_1d(data_array.attrs["quantiles"])[match[0]]
+
+    return data_array.quantile(q)
+
+
+def map_range(data_array):
+    '''min and max of a map, from its actual_range attribute when it has
+    one, else computed.'''
+
+    if "actual_range" in data_array.attrs:
+        return tuple(np.atleast_1d(data_array.attrs["actual_range"]))
+
+    return data_array.min(), data_array.max()
+
+
+def ensemble_mean(data_sets, var, lat, lon):
+    '''mean of the var maps of data_sets, a dict of data set keyed by model
+    name, regridded to the common grid of lat and lon.'''
+
+    # the single time step of each model's map is at a different date
+    maps = [regrid.regrid(data_set[var].squeeze(drop=True), lat, lon)
+            for data_set in data_sets.values()]
+
+    return xr.concat(maps, dim="model").mean("model").to_dataset(name=var)
+
+
+def make_plot(domain, var_option, ensemble=False):
     '''executes the making of plots, considers variable option from args'''
 
     path = "data-link/cordex-data"
     path_domain = f"{path}/mon/{domain}"
 
+    catalog.refresh(path_domain)
+
     if var_option is None:
-        vars = ds_store_remover(os.listdir(path_domain))
+        vars = catalog.list_dir(path_domain)
     else:
         vars = [var_option]
 
@@ -215,16 +277,18 @@ def make_plot(domain, var_option):
 
         path_var = f"{path_domain}/{var}"
 
-        make_plots_var(domain, var, path, path_var, type="yearmax")
+        make_plots_var(domain, var, path, path_var, type="yearmax",
+                       ensemble=ensemble)
 
         if var == "pr":
 
-            make_plots_var(domain, var, path, path_var, type="yearsum")
+            make_plots_var(domain, var, path, path_var, type="yearsum",
+                           ensemble=ensemble)
 
     return
 
 
-def make_plots_var(domain, var, path, path_var, type):
+def make_plots_var(domain, var, path, path_var, type, ensemble=False):
     '''makes plots for a particular variable'''
 
     path_slope = f"{path_var}/slope"
@@ -240,11 +304,11 @@ def make_plots_var(domain, var, path, path_var, type):
     timmean_min = []
     timmean_max = []
 
-    driving_models = ds_store_remover(os.listdir(path_slope))
+    driving_models = catalog.list_dir(path_slope)
 
     for driving_model in driving_models:
         path_driving_model = f"{path_slope}/{driving_model}"
-        rcms = ds_store_remover(os.listdir(path_driving_model))
+        rcms = catalog.list_dir(path_driving_model)
 
         for rcm in rcms:
             # TODO: could make the following into a function for reuse
@@ -253,20 +317,17 @@ def make_plots_var(domain, var, path, path_var, type):
             model_name = f"{driving_model}_{rcm}"
             model_names.append(model_name)
 
-            files = ds_store_remover(os.listdir(path_rcm))
-            files = [file for file in files if type in file]
-            files = [file for file in files if type in file]
-            file = files[0]
+            file = catalog.find(path_rcm, type=type)[0]["path"]
 
-            data_set = xr.open_dataset(f"{path_rcm}/{file}").isel(time=0)
+            data_set = xr.open_dataset(file).isel(time=0)
 
             if domain == "AUS-44":
 
                 if var == "pr":
                     if model_name == "ICHEC-EC-EARTH_CCLM4-8-17-CLM3-5":
-                        data_set[var] = data_set[var]/24
+                        data_set[var] = rescale(data_set[var], 24)
                     elif model_name == "MPI-M-MPI-ESM-LR_CCLM4-8-17-CLM3-5":
-                        data_set[var] = data_set[var]/24
+                        data_set[var] = rescale(data_set[var], 24)
 
             # here would be the place to scale data if wanted
 
@@ -285,21 +346,23 @@ def make_plots_var(domain, var, path, path_var, type):
                 data_set.coords["rlon"] = data_set.coords["rlon"] % 360
 
             # this might need to be edited on the fly to make more defined
+            # the quantiles are stored with the maps by the slope stage
             if var == "sfcWindmax":
-                slopes_min.append(data_set[var].quantile(0.1))
-                slopes_max.append(data_set[var].quantile(0.9))
+                slopes_min.append(map_quantile(data_set[var], 0.1))
+                slopes_max.append(map_quantile(data_set[var], 0.9))
             if var == "hurs":
-                slopes_min.append(data_set[var].quantile(0.2))
-                slopes_max.append(data_set[var].quantile(0.8))
+                slopes_min.append(map_quantile(data_set[var], 0.2))
+                slopes_max.append(map_quantile(data_set[var], 0.8))
             if var == "pr":
-                slopes_min.append(data_set[var].quantile(0.1))
-                slopes_max.append(data_set[var].quantile(0.9))
+                slopes_min.append(map_quantile(data_set[var], 0.1))
+                slopes_max.append(map_quantile(data_set[var], 0.9))
             elif var == "tasmax":
-                slopes_min.append(data_set[var].quantile(0.05))
-                slopes_max.append(data_set[var].quantile(0.95))
+                slopes_min.append(map_quantile(data_set[var], 0.05))
+                slopes_max.append(map_quantile(data_set[var], 0.95))
             else:
-                slopes_min.append(data_set[var].min())
-                slopes_max.append(data_set[var].max())
+                low, high = map_range(data_set[var])
+                slopes_min.append(low)
+                slopes_max.append(high)
 
             slopes[model_name] = data_set
 
@@ -307,30 +370,36 @@ def make_plots_var(domain, var, path, path_var, type):
             # this and the part above are similar - could make into function
             path_rcm = f"{path_timmean}/{driving_model}/{rcm}"
 
-            files = ds_store_remover(os.listdir(path_rcm))
-            files = [file for file in files if type in file]
-            files = [file for file in files if type in file]
-            file = files[0]
+            file = catalog.find(path_rcm, type=type)[0]["path"]
 
-            data_set = xr.open_dataset(f"{path_rcm}/{file}")
+            data_set = xr.open_dataset(file)
 
             if domain == "AUS-44":
 
                 if var == "pr":
                     if model_name == "ICHEC-EC-EARTH_CCLM4-8-17-CLM3-5":
-                        data_set[var] = data_set[var]/24
+                        data_set[var] = rescale(data_set[var], 24)
                     elif model_name == "MPI-M-MPI-ESM-LR_CCLM4-8-17-CLM3-5":
-                        data_set[var] = data_set[var]/24
+                        data_set[var] = rescale(data_set[var], 24)
 
             if var == "pr":
-                timmean_min.append(data_set[var].quantile(0.01))
-                timmean_max.append(data_set[var].quantile(0.99))
+                timmean_min.append(map_quantile(data_set[var], 0.01))
+                timmean_max.append(map_quantile(data_set[var], 0.99))
             else:
-                timmean_min.append(data_set[var].min())
-                timmean_max.append(data_set[var].max())
+                low, high = map_range(data_set[var])
+                timmean_min.append(low)
+                timmean_max.append(high)
 
             timmeans[model_name] = data_set
 
+    if ensemble:
+        lat, lon = regrid.common_grid(list(slopes.values()))
+
+        model_name = "Ensemble mean"
+        model_names.append(model_name)
+        slopes[model_name] = ensemble_mean(slopes, var, lat, lon)
+        timmeans[model_name] = ensemble_mean(timmeans, var, lat, lon)
+
     vmax_s, vmin_s = np.max(slopes_max), np.min(slopes_min)
     vmax_t, vmin_t = np.max(timmean_max), np.min(timmean_min)
 
@@ -470,7 +539,7 @@ def main(args):
         else:
             var_option = None
 
-        make_plot(domain, var_option)
+        make_plot(domain, var_option, ensemble=args.get('--ensemble', False))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,316 @@
+"""
+File: spatial_index.py
+Author: riley cooper
+Email: rwr.cooper@gmail.com
+Description:
+    Spatial index of the city boxes on a model grid. For each city the index
+    holds the integer index ranges of the box around the city and the mask of
+    the grid cells inside the box, so a city can be subset with a cheap isel
+    instead of a where over the whole grid. Indexes are keyed by a hash of the
+    grid's lat and lon coordinates (many RCMs share a grid) and saved to
+    index_path to be reused by later runs and other scripts. region_means
+    averages a field over the box of each city, weighted by the grid's cell
+    areas (cos(lat) on grids not in degrees), which are also cached per grid
+    in index_path. For cdo, index_box is
+    the selindexbox operator of a city's box and mask_file a netcdf of its
+    mask, also kept in index_path, so a city is subset within a chained cdo
+    command.
+"""
+
+
+import hashlib
+import json
+import os
+import numpy as np
+import xarray as xr
+import journal
+
+
+index_path = "data-link/cordex-data/spatial_index"
+
+
+# half width in degrees of the city boxes
+dist = 1
+
+
+earth_radius = 6371000.0
+
+
+def grid_hash(lat, lon):
+    '''hash of a grid's 2-D lat and lon coordinates and their dims.'''
+
+    sha = hashlib.sha1()
+    sha.update(",".join(lat.dims).encode())
+    for coord in [lat, lon]:
+        values = np.ascontiguousarray(np.round(coord.values, 5))
+        sha.update(str(values.shape).encode())
+        sha.update(values.astype("float64").tobytes())
+
+    return sha.hexdigest()[:16]
+
+
+def city_mask(lat, lon, city_lat_lon, dist):
+    '''mask of the grid cells within dist of a city, wr (whole region) is
+    every grid cell.'''
+
+    if city_lat_lon == 0:
+        return np.ones(lat.shape, dtype=bool)
+
+    # compare longitudes across the dateline too
+    lon_diff = (lon - city_lat_lon["lon"] + 180) % 360 - 180
+
+    mask = ((abs(lat - city_lat_lon["lat"]) < dist) &
+            (abs(lon_diff) < dist))
+    return mask
+
+
+def make_index(lat, lon, cities, dist):
+    '''makes the index of each city in cities (a domain of cities_lat_lon)
+    on a grid. Cities not on the grid are left out.'''
+
+    lat_values = lat.values
+    lon_values = lon.values
+
+    index = {}
+    for city in cities:
+        mask = city_mask(lat_values, lon_values, cities[city], dist)
+
+        rows = np.flatnonzero(mask.any(axis=1))
+        cols = np.flatnonzero(mask.any(axis=0))
+
+        if len(rows) == 0:
+            continue
+
+        ranges = np.array([rows[0], rows[-1] + 1, cols[0], cols[-1] + 1])
+
+        index[city] = {
+            "ranges": ranges,
+            "mask": mask[ranges[0]:ranges[1], ranges[2]:ranges[3]],
+        }
+
+    return index
+
+
+def save_index(index, file, dims, key):
+    '''saves an index to an npz file.'''
+
+    arrays = {
+        "dims": np.array(dims),
+        "key": np.array(key),
+    }
+    for city in index:
+        arrays[f"{city}_ranges"] = index[city]["ranges"]
+        arrays[f"{city}_mask"] = index[city]["mask"]
+
+    def write(temp):
+        with open(temp, "wb") as writer:
+            np.savez(writer, **arrays)
+
+    journal.atomic_write(file, write)
+
+
+def read_index(file, key):
+    '''reads an index saved with save_index, None if it was made for a
+    different set of cities.'''
+
+    with np.load(file) as arrays:
+        if str(arrays["key"]) != key:
+            return None
+
+        index = {}
+        for name in arrays.files:
+            if name.endswith("_ranges"):
+                city = name[:-len("_ranges")]
+                index[city] = {
+                    "ranges": arrays[name],
+                    "mask": arrays[f"{city}_mask"],
+                }
+
+    return index
+
+
+def load_index(lat, lon, cities, dist):
+    '''loads the index of cities on the grid of lat and lon from disk, making
+    and saving it first if needed.'''
+
+    key = json.dumps({"cities": cities, "dist": dist}, sort_keys=True)
+
+    os.makedirs(index_path, exist_ok=True)
+    file = f"{index_path}/{grid_hash(lat, lon)}.npz"
+
+    index = None
+    if os.path.exists(file):
+        index = read_index(file, key)
+
+    if index is None:
+        print(f"Making spatial index: {file}")
+        index = make_index(lat, lon, cities, dist)
+        save_index(index, file, lat.dims, key)
+
+    index["dims"] = lat.dims
+    index["grid"] = os.path.splitext(os.path.basename(file))[0]
+
+    return index
+
+
+def city_subset(data_set, index, city):
+    '''subsets a data set (or data array) to the box of a city, returns the
+    subset and the mask of the grid cells in the box.'''
+
+    y_dim, x_dim = index["dims"]
+    ranges = index[city]["ranges"]
+
+    subset = data_set.isel({
+        y_dim: slice(ranges[0], ranges[1]),
+        x_dim: slice(ranges[2], ranges[3])})
+
+    return subset, index[city]["mask"]
+
+
+def index_box(index, city):
+    '''cdo selindexbox operator of the box of a city.'''
+
+    ranges = index[city]["ranges"]
+
+    # cdo indexes are 1-based and inclusive, x first
+    return (f"selindexbox,{ranges[2] + 1},{ranges[3]},"
+            f"{ranges[0] + 1},{ranges[1]}")
+
+
+def mask_file(data_set, var, index, city):
+    '''netcdf of the mask of a city's box on the grid of var, 1 inside and
+    0 outside, for cdo ifthen after index_box. Made once per grid and
+    city.'''
+
+    file = f"{index_path}/{index['grid']}_{city}_mask.nc"
+
+    if os.path.exists(file):
+        return file
+
+    print(f"Making city mask: {file}")
+
+    field = data_set[var].isel(time=0, drop=True)
+    box, mask = city_subset(field, index, city)
+
+    mask_set = box.copy(data=mask.astype("float32")).drop_encoding()
+    mask_set.attrs = {"long_name": f"Mask of {city}"}
+    mask_set = mask_set.to_dataset(name="mask")
+
+    # keep the grid of var so cdo sees the same grid
+    grid_mapping = field.attrs.get("grid_mapping")
+    if grid_mapping in data_set:
+        mask_set["mask"].attrs["grid_mapping"] = grid_mapping
+        mask_set[grid_mapping] = data_set[grid_mapping]
+
+    journal.atomic_write(file, mask_set.to_netcdf)
+
+    return file
+
+
+def degree_axes(data_set, dims):
+    '''True if the y and x dims of a data set are coordinates in degrees,
+    as the rlat and rlon of a rotated pole grid.'''
+
+    for dim in dims:
+        if dim not in data_set.coords:
+            return False
+
+        attrs = data_set[dim].attrs
+        in_degrees = (
+            attrs.get("units", "").startswith("degree") or
+            attrs.get("standard_name") in ["grid_latitude", "latitude",
+                                           "grid_longitude", "longitude"] or
+            dim in ["rlat", "rlon", "lat", "lon"])
+
+        if not in_degrees:
+            return False
+
+    return True
+
+
+def cell_edges(centres):
+    '''edges of the cells of 1-D cell centres, half way between centres.'''
+
+    middle = (centres[1:] + centres[:-1]) / 2
+    first = 2 * centres[0] - middle[0]
+    last = 2 * centres[-1] - middle[-1]
+
+    return np.concatenate([[first], middle, [last]])
+
+
+def cell_areas(data_set, dims):
+    '''areas in m2 of the cells of a grid in degrees, rotated or not, the
+    area of a cell between two parallels and two meridians is the same in
+    the rotated coordinates.'''
+
+    y_dim, x_dim = dims
+
+    y_edges = np.deg2rad(cell_edges(data_set[y_dim].values))
+    x_edges = np.deg2rad(cell_edges(data_set[x_dim].values))
+
+    y_bands = np.abs(np.diff(np.sin(np.clip(y_edges, -np.pi/2, np.pi/2))))
+    x_widths = np.abs(np.diff(x_edges))
+
+    return earth_radius ** 2 * np.outer(y_bands, x_widths)
+
+
+def load_weights(data_set, index):
+    '''(y, x) array of the cell weights of the grid of an index (see
+    load_index) from disk, making and saving it first if needed. The
+    weights are cell areas, or cos(lat) if the grid isn't in degrees.'''
+
+    file = f"{index_path}/{index['grid']}_weights.npy"
+
+    if os.path.exists(file):
+        return np.load(file)
+
+    print(f"Making cell weights: {file}")
+
+    dims = index["dims"]
+    if degree_axes(data_set, dims):
+        weights = cell_areas(data_set, dims)
+    else:
+        weights = np.cos(np.deg2rad(data_set["lat"].values))
+
+    def write(temp):
+        with open(temp, "wb") as writer:
+            np.save(writer, weights)
+
+    journal.atomic_write(file, write)
+
+    return weights
+
+
+def region_weights(index, city, weights):
+    '''(y, x) data array of the weights of the grid cells in the box of a
+    city, zero outside its mask.'''
+
+    ranges = index[city]["ranges"]
+    box = (slice(ranges[0], ranges[1]), slice(ranges[2], ranges[3]))
+
+    return xr.DataArray(np.where(index[city]["mask"], weights[box], 0),
+                        dims=list(index["dims"]))
+
+
+def region_means(data_array, index, cities, weights):
+    '''weighted means of a (time, y, x) data array over the box of each of
+    cities (all in index), each reduced over its box subset with isel, so
+    only the whole region (wr) is reduced over the full grid. Lazy data is
+    read once when the means are computed together. Returns a (time, city)
+    data array.'''
+
+    spatial_dims = list(index["dims"])
+
+    means = []
+    for city in cities:
+        box, _ = city_subset(data_array, index, city)
+        region = region_weights(index, city, weights)
+
+        valid = box.notnull().astype(box.dtype)
+        total = xr.dot(box.fillna(0), region, dim=spatial_dims)
+        norm = xr.dot(valid, region, dim=spatial_dims)
+        means.append(total / norm)
+
+    means = xr.concat(means, dim="city").assign_coords(city=cities)
+
+    return means.transpose(..., "city")
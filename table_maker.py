@@ -7,21 +7,46 @@ Description:
     available CORDEX data. This can be used to get an idea of what data is
     available before performing the multi-model analyses.
 
+    The searches of ESGF are cached on disk for ttl hours, see
+    search_cache.py, with the offline option only the cache is used. The
+    data sets of the search are fetched in pages, pages at a time.
+
+    update-search keeps a parquet snapshot of the table of the search,
+    parquet_files/cordex_search.parquet, a row per data set id (which
+    includes its version) with the time ESGF last indexed it. An update
+    only asks ESGF for the data sets indexed since the latest of those
+    times and merges them into the snapshot. The data sets it finds were
+    either added, retracted or changed (a change of their meta data), these
+    are appended to csv_files/cordex_search_changes.csv. Data sets
+    unpublished without being retracted don't show up in an update, the full
+    option searches everything again, and the data sets of the snapshot
+    missing from it are recorded as removed. The domain, model and specific
+    facet tables are made from the snapshot, without ESGF.
+
 Usage:
-    table_maker update-search
+    table_maker update-search [--full] [options]
     table_maker domain-table <domain>
-    table_maker facet-table <facet> <specific>
+    table_maker facet-table <facet> <specific> [options]
     table_maker model-domain-table
     table_maker domain-model-table
     table_maker (-h | --help | --version)
 
 Options:
     -h, --help          Show this screen and exit.
+    --ttl=<hours>       Hours the cached searches of ESGF are reused
+                        [default: 24].
+    --offline           Only use the cached searches of ESGF.
+    --search_cache=<dir>  Directory of the cached searches of ESGF.
+    --pages=<pages>     Pages of the search fetched at once [default: 4].
+    --full              Search all the data sets again rather than those
+                        indexed since the snapshot.
 """
 
-from pyesgf.search import SearchConnection
+import os
+import numpy as np
 import pandas as pd
 from docopt import docopt
+import search_cache
 
 
 HTML_TPL = """
@@ -191,60 +216,139 @@ meta_data = ['domain', 'variable', 'time_frequency', 'ensemble', 'experiment',
              'number_of_files', 'driving_model']
 
 
-conn = SearchConnection('https://esgf-node.llnl.gov/esg-search', distrib=True)
+# snapshot of the table of the last update-search
+snapshot_file = 'parquet_files/cordex_search.parquet'
+
+# fields of the snapshot besides meta_data, telling the versions, updates and
+# retractions of the data sets apart
+snapshot_fields = ['version', '_timestamp', 'retracted']
+
+# log of the data sets added, retracted, changed or removed by the updates
+changes_file = 'csv_files/cordex_search_changes.csv'
 
-ctx = conn.new_context(project='CORDEX', domain=','.join(domains_res),
-                       time_frequency=','.join(time_frequencies),
-                       variable=','.join(variables))
+
+# the specific search
+constraints = {
+    "project": 'CORDEX',
+    "domain": ','.join(domains_res),
+    "time_frequency": ','.join(time_frequencies),
+    "variable": ','.join(variables),
+}
 
 # full CORDEX search
-ctx_full = conn.new_context(project='CORDEX')
+constraints_full = {"project": 'CORDEX'}
 
 
 def make_table(domain_list, time_frequency_list, variables_list,
-               meta_data_list):
-    '''function to make table, context (ctx), result set, hit count.'''
-    # rs = ResultsSet
+               meta_data_list, since=None):
+    '''function to make table, result json, hit count. With since, only
+    the data sets ESGF indexed from that time.'''
+    # rs = json of the results
     # hc = hit count
 
-    results_table = pd.DataFrame(columns=meta_data)
-    ctx = conn.new_context(project='CORDEX',
-                           domain=','.join(domain_list),
-                           time_frequency=','.join(time_frequency_list),
-                           variable=','.join(variables_list))
-    hc = ctx.hit_count
-    rs = ctx.search()
-    results_table_len = 0
+    search = {"project": 'CORDEX',
+              "domain": ','.join(domain_list),
+              "time_frequency": ','.join(time_frequency_list),
+              "variable": ','.join(variables_list),
+              "from": since}
+    rs = search_cache.search(search, fields=meta_data_list)
+    hc = len(rs)
+
+    # a list per column, made into the table at once
+    columns = {data: [] for data in meta_data_list}
+    for dataset_json in rs:
+        for data in meta_data_list:
+            val = dataset_json.get(data)
+            columns[data].append(val[0] if isinstance(val, list) else val)
+
+    results_table = pd.DataFrame(columns, columns=meta_data_list)
+
+    return(rs, results_table, hc)
+
+
+def read_snapshot():
+    '''the snapshot of the last update-search, None if there isn't one.'''
+
+    if not os.path.exists(snapshot_file):
+        return None
+
+    return pd.read_parquet(snapshot_file)
+
+
+def read_table():
+    '''the table of the data sets of the last update-search, those of the
+    snapshot not retracted, None if there isn't a snapshot.'''
+
+    table = read_snapshot()
+    if table is None:
+        return None
+
+    return table[~table['retracted']].reset_index(drop=True)
+
+
+def search_changes(snapshot, update, full=False):
+    '''the data sets of update, a table of those indexed since snapshot,
+    that were added, retracted or changed, as a table of their id, version
+    and change. With full, update is the whole search and the data sets of
+    the snapshot not in it were removed.'''
+
+    old = snapshot[~snapshot['retracted']].set_index('id')
+    new = update.set_index('id')
+
+    seen = new.index.isin(old.index)
+    retracted = new['retracted'].to_numpy()
+
+    columns = [data for data in meta_data + ['version'] if data != 'id']
+    ids = new.index[seen]
+    changed = np.zeros(len(new), dtype=bool)
+    changed[seen] = (new.loc[ids, columns].astype(str).to_numpy() !=
+                     old.loc[ids, columns].astype(str).to_numpy()).any(axis=1)
+
+    kinds = {
+        'added': ~seen & ~retracted,
+        'retracted': seen & retracted,
+        'changed': seen & ~retracted & changed,
+    }
+
+    changes = [new.loc[rows, ['version']].assign(change=kind)
+               for kind, rows in kinds.items()]
+
+    if full:
+        removed = ~old.index.isin(new.index)
+        changes.append(
+            old.loc[removed, ['version']].assign(change='removed'))
 
-    for i in range(hc):
-        to_append = []
-        dataset = rs[i]
-        dataset_json = dataset.json
+    return pd.concat(changes).reset_index()[['id', 'version', 'change']]
 
-        for data in meta_data:
-            val = dataset_json[data]
-            to_append.append(val[0] if isinstance(val, list) else val)
 
-        results_table.loc[results_table_len] = to_append
-        results_table_len = results_table_len+1
+def record_changes(changes):
+    '''appends the changes of an update to the log of changes.'''
 
-    return(ctx, rs, results_table, hc)
+    changes = changes.assign(time=pd.Timestamp.now(tz='UTC').isoformat())
+
+    changes.to_csv(changes_file, mode='a', index=False,
+                   header=not os.path.exists(changes_file))
 
 
 def main_facet_table(facet_chosen, specific):
     '''Makes full facet table'''
     if specific:
-        ctx_local = ctx
+        constraints_local = constraints
         title_search = "specific"
         fn = ""
 
     else:
-        ctx_local = ctx_full
+        constraints_local = constraints_full
         title_search = "full"
         fn = "_full"
 
-    # function to make the table
-    facet_count_table = ctx_local.facet_counts[facet_chosen]
+    # function to make the table, of the specific search from the snapshot
+    table = read_table() if specific else None
+    if table is not None and facet_chosen in table:
+        facet_count_table = table[facet_chosen].value_counts()
+    else:
+        facet_count_table = search_cache.facet_counts(
+            constraints_local)[facet_chosen]
     facet_count_table = pd.Series(facet_count_table, name='count').sort_values(
         ascending=False)
 
@@ -255,18 +359,52 @@ def main_facet_table(facet_chosen, specific):
     with open(f'html_files/{facet_chosen}{fn}_table.html', 'w') as f:
         f.write(HTML_TPL.format(table=counts_table_html, css=CSS,
                                 script=SCRIPT, title_search=title_search,
-                                title_facet=title_facet))
+                                title_facet=facet_chosen))
     return
 
 
-def main_update_search():
-    ''''''
-    ctx, rs, table, hc = make_table(domains_res, time_frequencies, variables,
-                                    meta_data)
-    ctx_full = conn.new_context(project='CORDEX')
+def main_update_search(full=False):
+    '''updates the snapshot of the search with the data sets ESGF indexed
+    since it, or with full, all of them, and saves its table.'''
+
+    snapshot = read_snapshot()
+    if snapshot is None:
+        full = True
+
+    since = None if full else snapshot['_timestamp'].max()
+    if since:
+        print(f"Searching for data sets indexed since: {since}")
+
+    rs, update, hc = make_table(domains_res, time_frequencies, variables,
+                                meta_data + snapshot_fields, since)
+
+    update['version'] = update['version'].astype(str)
+    update['retracted'] = update['retracted'].eq(True)
 
     # add column parent domain
-    table['parent_domain'] = table['domain'].apply(lambda x: x.split('-')[0])
+    update['parent_domain'] = update['domain'].apply(
+        lambda x: x.split('-')[0])
+
+    if snapshot is None:
+        snapshot = update.iloc[:0]
+
+    changes = search_changes(snapshot, update, full)
+    record_changes(changes)
+    for change, count in changes['change'].value_counts().items():
+        print(f"Data sets {change}: {count}")
+
+    if full:
+        snapshot = update
+    else:
+        snapshot = pd.concat(
+            [snapshot[~snapshot['id'].isin(update['id'])], update],
+            ignore_index=True)
+
+    # save snapshot
+    os.makedirs(os.path.dirname(snapshot_file), exist_ok=True)
+    snapshot.to_parquet(snapshot_file)
+
+    table = read_table()
 
     # save to html
     with open('html_files/cordex_search.html', 'w') as f:
@@ -275,16 +413,18 @@ def main_update_search():
     # save to csv
     with open('csv_files/cordex_search.csv', 'w') as f:
         f.write(table.to_csv())
-    return(ctx, ctx_full, table)
 
+    return(rs, table)
 
-def main_domain_table(domain_chosen):
+
+def main_domain_table(table, domain_chosen):
     '''make table give a domain,
         makes html file for table with:
             domain, variables, driving_model, rcm_name'''
 
     domain_table = table[table['domain'] == domain_chosen].groupby(
-        ['domain', 'variable', 'driving_model', 'rcm_name']).size()
+        ['domain', 'variable', 'driving_model', 'rcm_name']).size(
+        ).to_frame()
 
     # save to html
     domain_table_html = domain_table.to_html()
@@ -295,7 +435,7 @@ def main_domain_table(domain_chosen):
 
 # make tables
 # table 1: model -> domain (name this table_model_domain)
-def main_model_domain_table():
+def main_model_domain_table(table):
     '''makes table with first heirarchy model, then domain.'''
 
     # make the model_domain_table
@@ -348,7 +488,7 @@ def main_model_domain_table():
     return
 
 
-def main_domain_model_table():
+def main_domain_model_table(table):
     '''makes table with first heirarchy domain, then model.'''
 
     table_domain_model = table.groupby(
@@ -402,32 +542,50 @@ def main_domain_model_table():
                 css=CSS, script=SCRIPT))
 
     # save to csv file
-    table_domain_model_sorted.git to_csv("csv_files/table_domain_model_sorted.csv")
+    table_domain_model_sorted.to_csv("csv_files/table_domain_model_sorted.csv")
     return
 
 
 def main(args):
 
-    return
+    if args.get('--ttl'):
+        search_cache.config["ttl"] = float(args['--ttl']) * 3600
+
+    if args.get('--offline'):
+        search_cache.config["offline"] = True
+
+    if args.get('--search_cache'):
+        search_cache.cache_path = args['--search_cache']
+
+    if args.get('--pages'):
+        search_cache.config["pages"] = int(args['--pages'])
 
     domain_chosen = args['<domain>']
     facet_chosen = args['<facet>']
     specific = args['<specific>']
 
     if args['update-search']:
-        main_update_search()
-
-    elif args['domain-table']:
-        main_domain_table(domain_chosen)
+        main_update_search(args['--full'])
 
     elif args['facet-table']:
         main_facet_table(facet_chosen, specific)
 
-    elif args['model-domain-table']:
-        main_model_domain_table()
+    # the other tables are made from the snapshot
+    else:
+        table = read_table()
+
+        if table is None:
+            print(f"No search snapshot at {snapshot_file}, run "
+                  f"update-search first.")
+
+        elif args['domain-table']:
+            main_domain_table(table, domain_chosen)
+
+        elif args['model-domain-table']:
+            main_model_domain_table(table)
 
-    elif args['domain-model-table']:
-        main_domain_model_table()
+        elif args['domain-model-table']:
+            main_domain_model_table(table)
 
 
 if __name__ == '__main__':
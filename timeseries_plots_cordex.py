@@ -5,6 +5,9 @@ Author: riley cooper
 Email: rwr.cooper@gmail.com
 Description:
     Script for creation of timeseries plots of a hazard for cities in a domain.
+    The timeseries are read from the timeseries files of pre-processor.py.
+    Directories are looked up in the catalog of the data tree, see
+    catalog.py.
 
 Usage:
     timeseries_plots_cordex.py make-plots -d <domain> [-v <var_option]
@@ -24,7 +27,7 @@ from docopt import docopt
 from csaps import csaps
 import pandas as pd
 import os
-from ds_store_remover import ds_store_remover
+import catalog
 import json
 
 
@@ -93,11 +96,10 @@ def make_colors(data_path, domain, var):
 
     counter = 0
 
-    driving_models = ds_store_remover(os.listdir(path_timeseries))
+    driving_models = catalog.list_dir(path_timeseries)
     driving_models = [dm for dm in driving_models if dm != "ECMWF-ERAINT"]
     for driving_model in driving_models:
-        rcms = ds_store_remover(
-            os.listdir(f"{path_timeseries}/{driving_model}"))
+        rcms = catalog.list_dir(f"{path_timeseries}/{driving_model}")
         for rcm in rcms:
             model_name = f"{driving_model}_{rcm}"
             colors[model_name] = color_list[counter]
@@ -110,8 +112,10 @@ def make_plots(domain, var_option):
     data_path = "data-link/cordex-data/mon"
     plot_path = "data-link/cordex-data/plots"
 
+    catalog.refresh(f"{data_path}/{domain}")
+
     if var_option is None:
-        vars = ds_store_remover(os.listdir(f"{data_path}/{domain}"))
+        vars = catalog.list_dir(f"{data_path}/{domain}")
     else:
         vars = [var_option]
 
@@ -138,26 +142,22 @@ def make_plot(domain, data_path, plot_path, colors, var, type):
 
     for i, city in enumerate(cities_lat_lon[domain]):
         ax = axes.ravel()[i]
-        driving_models = ds_store_remover(os.listdir(path_timeseries))
+        driving_models = catalog.list_dir(path_timeseries)
 
         # loop over driving_models
         for driving_model in driving_models:
-            rcms = ds_store_remover(
-                os.listdir(f"{path_timeseries}/{driving_model}"))
+            rcms = catalog.list_dir(f"{path_timeseries}/{driving_model}")
 
             for rcm in rcms:
 
                 model_name = f"{driving_model}_{rcm}"
 
                 data_set_path = f"{path_timeseries}/{driving_model}/{rcm}"
-                files = ds_store_remover(os.listdir(data_set_path))
-                files = [file for file in files if city in file]
-                files = [file for file in files if type in file]
+                files = catalog.find(data_set_path, city=city, type=type)
 
                 if files != []:
 
-                    file = files[0]
-                    ds = xr.open_dataset(f"{data_set_path}/{file}")
+                    ds = xr.open_dataset(files[0]["path"])
 
                     # Fix known problem with downloaded data sets
                     if domain == "AUS-44" and var == "pr":
@@ -0,0 +1,267 @@
+"""
+File: trend_kernel.py
+Author: riley cooper
+Email: rwr.cooper@gmail.com
+Description:
+    Closed form least squares trend and time-mean of each grid cell of a
+    yearly (time, y, x) cube, computed in a single pass over chunks of time
+    steps. Replaces the cdo -timmean and cdo -trend passes over the same
+    file: only running sums are kept, so memory is one chunk of the cube,
+    and the slope, intercept, residual variance and slope standard error
+    all come from the same sums. Missing values are handled per grid cell.
+    The same pass can also give statistics of each grid cell over each of
+    the two periods: mean, std, min, max, percentiles (p<percent>, e.g.
+    p95) and counts of values above a threshold (gt<threshold>), see
+    statistic_names. Grid cells are independent, so slope_timmean_blocks
+    runs the same fit as a lazy dask task per spatial chunk of a dask backed
+    cube.
+"""
+
+
+import warnings
+import numpy as np
+import xarray as xr
+
+
+def period_mask(years, period):
+    '''mask of the years within period, a (start, end) pair of years.'''
+
+    return (years >= period[0]) & (years <= period[1])
+
+
+def statistic_names(statistics, periods):
+    '''names of the fields of statistics over periods, e.g. p95_1981_2010,
+    raises a ValueError for an unknown statistic.'''
+
+    for statistic in statistics:
+        if statistic in ["mean", "std", "min", "max"]:
+            continue
+
+        try:
+            if statistic.startswith("p"):
+                if not 0 <= float(statistic[1:]) <= 100:
+                    raise ValueError
+                continue
+            if statistic.startswith("gt"):
+                float(statistic[2:])
+                continue
+        except ValueError:
+            pass
+
+        raise ValueError(f"Unknown statistic: {statistic}")
+
+    return [f"{statistic}_{period[0]}_{period[1]}"
+            for period in periods for statistic in statistics]
+
+
+def new_period_sums(shape, rows, statistics):
+    '''running sums of the statistics of a period of rows time steps over a
+    grid of shape, with the values of the period kept for percentiles.'''
+
+    sums = {
+        "n": np.zeros(shape),
+        "sum": np.zeros(shape),
+        "sumsq": np.zeros(shape),
+        "min": np.full(shape, np.nan),
+        "max": np.full(shape, np.nan),
+        "row": 0,
+    }
+
+    for statistic in statistics:
+        if statistic.startswith("gt"):
+            sums[statistic] = np.zeros(shape)
+
+    if any(statistic.startswith("p") for statistic in statistics):
+        sums["values"] = np.empty((rows,) + shape, dtype="float32")
+
+    return sums
+
+
+def add_period_block(sums, block, statistics):
+    '''adds a block of time steps of a period, with missing values, to its
+    running sums.'''
+
+    valid = ~np.isnan(block)
+    values = np.where(valid, block, 0)
+
+    sums["n"] += valid.sum(axis=0)
+    sums["sum"] += values.sum(axis=0)
+    sums["sumsq"] += (values ** 2).sum(axis=0)
+
+    with np.errstate(invalid="ignore"):
+        sums["min"] = np.fmin(sums["min"], np.fmin.reduce(block, axis=0))
+        sums["max"] = np.fmax(sums["max"], np.fmax.reduce(block, axis=0))
+
+        for statistic in statistics:
+            if statistic.startswith("gt"):
+                sums[statistic] += (block > float(statistic[2:])).sum(axis=0)
+
+    if "values" in sums:
+        sums["values"][sums["row"]:sums["row"] + len(block)] = block
+        sums["row"] += len(block)
+
+
+def period_statistics(sums, statistics):
+    '''the fields of statistics from the running sums of a period.'''
+
+    n = sums["n"]
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mean = sums["sum"] / n
+        variance = np.maximum(sums["sumsq"] / n - mean ** 2, 0)
+
+    fields = {}
+    for statistic in statistics:
+        if statistic == "mean":
+            field = mean
+        elif statistic == "std":
+            field = np.sqrt(variance)
+        elif statistic in ["min", "max"]:
+            field = sums[statistic]
+        elif statistic.startswith("gt"):
+            field = sums[statistic]
+        elif statistic.startswith("p"):
+            # cells with no values are all-NaN slices, masked below
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore", RuntimeWarning)
+                field = np.nanpercentile(
+                    sums["values"][:sums["row"]], float(statistic[1:]),
+                    axis=0)
+
+        fields[statistic] = np.where(n > 0, field, np.nan)
+
+    return fields
+
+
+def slope_timmean(data_array, trend_period=(2000, 2100),
+                  timmean_period=(1981, 2010), chunk_size=20,
+                  statistics=()):
+    '''trend of data_array over trend_period and its time-mean over
+    timmean_period, from one pass over chunks of chunk_size time steps.
+    Returns a dict of 2-D arrays: slope (per year), intercept (value of the
+    fit in the first year of trend_period), resvar (residual variance),
+    stderr (standard error of the slope) and timmean, and the statistics of
+    each period from the same pass, named as in statistic_names.'''
+
+    years = data_array["time"].dt.year.values
+    in_trend = period_mask(years, trend_period)
+    in_timmean = period_mask(years, timmean_period)
+
+    # centre time on the trend period for a well conditioned fit
+    centre = years[in_trend].mean()
+    t = (years - centre).astype("float64")
+
+    shape = data_array.shape[1:]
+    sums = {name: np.zeros(shape)
+            for name in ["n", "t", "tt", "y", "ty", "yy", "timmean",
+                         "n_timmean"]}
+
+    rows = np.flatnonzero(in_trend | in_timmean)
+
+    periods = {trend_period: in_trend, timmean_period: in_timmean}
+    period_sums = {}
+    if statistics:
+        statistic_names(statistics, periods)
+        period_sums = {
+            period: new_period_sums(shape, in_period.sum(), statistics)
+            for period, in_period in periods.items()}
+
+    for start in range(0, len(rows), chunk_size):
+        chunk = rows[start:start + chunk_size]
+
+        # one read of the chunk serves both the trend and the time-mean
+        block = data_array.isel(time=chunk).values.astype("float64")
+
+        for period, period_sum in period_sums.items():
+            in_period = periods[period][chunk]
+            if in_period.any():
+                add_period_block(period_sum, block[in_period], statistics)
+        valid = ~np.isnan(block)
+        block = np.where(valid, block, 0)
+        valid = valid.astype("float64")
+
+        trend = in_trend[chunk].astype("float64")
+        t_chunk = trend * t[chunk]
+
+        sums["n"] += np.tensordot(trend, valid, axes=1)
+        sums["t"] += np.tensordot(t_chunk, valid, axes=1)
+        sums["tt"] += np.tensordot(t_chunk ** 2, valid, axes=1)
+        sums["y"] += np.tensordot(trend, block, axes=1)
+        sums["ty"] += np.tensordot(t_chunk, block, axes=1)
+        sums["yy"] += np.tensordot(trend, block ** 2, axes=1)
+
+        timmean = in_timmean[chunk].astype("float64")
+        sums["timmean"] += np.tensordot(timmean, block, axes=1)
+        sums["n_timmean"] += np.tensordot(timmean, valid, axes=1)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        n = sums["n"]
+        sxx = sums["tt"] - sums["t"] ** 2 / n
+        sxy = sums["ty"] - sums["t"] * sums["y"] / n
+        syy = sums["yy"] - sums["y"] ** 2 / n
+
+        slope = sxy / sxx
+        intercept = (sums["y"] - slope * sums["t"]) / n
+        intercept = intercept + slope * (trend_period[0] - centre)
+
+        resvar = np.maximum(syy - slope * sxy, 0) / (n - 2)
+        stderr = np.sqrt(resvar / sxx)
+
+        timmean = sums["timmean"] / sums["n_timmean"]
+
+    # cells with too few values to fit are missing, as in cdo
+    slope[n < 2] = np.nan
+    intercept[n < 2] = np.nan
+    resvar[n < 3] = np.nan
+    stderr[n < 3] = np.nan
+
+    fit = {
+        "slope": slope,
+        "intercept": intercept,
+        "resvar": resvar,
+        "stderr": stderr,
+        "timmean": timmean,
+    }
+
+    for period, period_sum in period_sums.items():
+        fields = period_statistics(period_sum, statistics)
+        for statistic, field in fields.items():
+            fit[f"{statistic}_{period[0]}_{period[1]}"] = field
+
+    return fit
+
+
+def fit_block(block, trend_period, timmean_period, statistics=()):
+    '''slope_timmean of a single block of a cube, as a data set.'''
+
+    fit = slope_timmean(block, trend_period, timmean_period,
+                        statistics=statistics)
+
+    dims = block.dims[1:]
+    coords = {dim: block[dim] for dim in dims if dim in block.coords}
+
+    return xr.Dataset(
+        {name: (dims, field) for name, field in fit.items()}, coords=coords)
+
+
+def slope_timmean_blocks(data_array, trend_period=(2000, 2100),
+                         timmean_period=(1981, 2010), statistics=()):
+    '''slope_timmean of a dask backed (time, y, x) data array as a lazy
+    task per spatial chunk, time is rechunked to a single chunk. Returns a
+    dict of lazy 2-D data arrays, computed together with dask.compute.'''
+
+    time_dim = data_array.dims[0]
+    data_array = data_array.reset_coords(drop=True).chunk({time_dim: -1})
+
+    field = data_array.isel({time_dim: 0}, drop=True).astype("float64")
+    names = ["slope", "intercept", "resvar", "stderr", "timmean"]
+    if statistics:
+        names += statistic_names(statistics, [trend_period, timmean_period])
+    template = xr.Dataset({name: field for name in names})
+
+    fit = xr.map_blocks(
+        fit_block, data_array,
+        args=[trend_period, timmean_period, list(statistics)],
+        template=template)
+
+    return {name: fit[name] for name in fit.data_vars}
@@ -5,15 +5,22 @@ Author: riley cooper
 Email: rwr.cooper@gmail.com
 Description:
     Script to make heatmap and table of values for the slope values of
-    time-series data for a hazard and location pair.
+    time-series data for a hazard and location pair. The slopes are computed
+    from the timeseries files of pre-processor.py with cdo. Directories are
+    looked up in the catalog of the data tree, see catalog.py. The cdo
+    trends of every model and city of a type run as subprocesses, up to
+    cdo_jobs at once, see cdo_runner.py. The slope files are encoded by the
+    policy of the encoding option, see netcdf_encoding.py.
 
 Usage:
-    trend_value_table.py pre-process -d <domain> [-v <var_option]
+    trend_value_table.py pre-process -d <domain> [-v <var_option] [--cdo_jobs=<cdo_jobs>] [--encoding=<file>]
     trend_value_table.py make-table -d <domain> [-v <var_option>]
 
 Options:
     -d <domain>, --domain=<domain>
     -v <var_option>, --var_option=<var_option>
+    --cdo_jobs=<cdo_jobs>  cdo commands run at once [default: 4]
+    --encoding=<file>  encoding policy of the outputs [default: netcdf_encoding.json]
 
     -h, --help
     --option=<n>
@@ -26,7 +33,9 @@ import pandas as pd
 import os
 import matplotlib.pyplot as plt
 import seaborn as sns
-from ds_store_remover import ds_store_remover
+import catalog
+import cdo_runner
+import netcdf_encoding
 import json
 
 
@@ -38,6 +47,12 @@ dict = open("cities_lat_lon.json")
 cities_lat_lon = json.load(dict)
 
 
+# run options, set from the command line in main
+config = {
+    "cdo_jobs": 4,
+}
+
+
 def get_slopes(path_var, domain, var, cities_lat_lon, type):
     '''Calculate slopes for variables over 1951-2100 for each model for each
     city'''
@@ -50,31 +65,25 @@ def get_slopes(path_var, domain, var, cities_lat_lon, type):
         }
     path_timeslope = f"{path_var}/timeseries_slopes"
 
-    driving_models = ds_store_remover(os.listdir(path_timeslope))
+    driving_models = catalog.list_dir(path_timeslope)
 
     for driving_model in driving_models:
         path_dm = f"{path_timeslope}/{driving_model}"
-        rcms = ds_store_remover(os.listdir(path_dm))
+        rcms = catalog.list_dir(path_dm)
 
         for rcm in rcms:
             path_rcm = f"{path_dm}/{rcm}"
 
             for city in cities_lat_lon[domain]:
 
-                files = ds_store_remover(os.listdir(path_rcm))
+                files = catalog.find(path_rcm, city=city, type=type)
 
                 # print(f"Rcm path: {path_rcm}")
-                # print(f"Files: {files}")
-
-                files = [file for file in files if city in file]
-                files = [file for file in files if type in file]
-                files = [file for file in files if "slope" in file]
-
                 # print(f"City: {city}")
                 # print(f"Type: {type}")
-                # print(f"Revised files: {files}")
+                # print(f"Files: {files}")
 
-                file = f"{path_rcm}/{files[0]}"
+                file = files[0]["path"]
 
                 ds = xr.open_dataset(file)
 
@@ -174,7 +183,7 @@ def make_table(path, domain, type, cities_lat_lon, var_option):
 
     path = f"{path}/{domain}"
 
-    vars = ds_store_remover(os.listdir(path))
+    vars = catalog.list_dir(path)
 
     if var_option is None:
         for var in vars:
@@ -191,51 +200,42 @@ def make_slope(path_var, domain, var, cities_lat_lon, type):
     path_timeseries = f"{path_var}/timeseries"
     os.makedirs(path_timeslope, exist_ok=True)
 
-    driving_models = ds_store_remover(os.listdir(path_timeseries))
+    driving_models = catalog.list_dir(path_timeseries)
     driving_models = [dm for dm in driving_models if "ERAINT" not in dm]
 
+    cmds = []
+
     for driving_model in driving_models:
         path_dm = f"{path_timeseries}/{driving_model}"
-        rcms = ds_store_remover(os.listdir(path_dm))
+        rcms = catalog.list_dir(path_dm)
 
         for rcm in rcms:
             path_rcm = f"{path_dm}/{rcm}"
 
             for city in cities_lat_lon[domain]:
 
-                files = ds_store_remover(os.listdir(path_rcm))
-                files = [file for file in files if city in file]
-                files = [file for file in files if type in file]
+                files = catalog.find(path_rcm, city=city, type=type)
 
                 print(f"Path: {path_rcm}")
 
-                infile = f"{path_rcm}/{files[0]}"
+                infile = files[0]["path"]
 
                 save_path = f"{path_timeslope}/{driving_model}/{rcm}"
 
                 os.makedirs(save_path, exist_ok=True)
 
-                outfile_int = f"temp/{driving_model}_{rcm}_{city}_{type}"
-                outfile_int = outfile_int + "_intercept.nc"
+                outfile_slope = f"{driving_model}_{rcm}_{city}_{type}"
+                outfile_slope = f"{save_path}/{outfile_slope}_slope.nc"
 
-                outfile_slope = f"temp/{driving_model}_{rcm}_{city}_{type}"
-                outfile_slope = outfile_slope + "_slope.nc"
+                # regres is the slope of trend, written straight to
+                # save_path without the intercept
+                cmds.append(cdo_runner.fuse(
+                    ["selyear,2000/2100", "regres"], [infile],
+                    [outfile_slope],
+                    options=netcdf_encoding.cdo_options("trend")))
 
-                # make files
-                cmd = f"touch {outfile_int}"
-                print(f"Running command: {cmd}")
-                os.system(cmd)
-
-                cmd = f"touch {outfile_slope}"
-                print(f"Running command: {cmd}")
-                os.system(cmd)
-
-                cmd = "cdo -L -trend -selyear,2000/2100 "
-                cmd = cmd + f"{infile} {outfile_int} {outfile_slope}"
-                print(f"Running command: {cmd}")
-                os.system(cmd)
-
-                os.system(f"mv {outfile_slope} {save_path}")
+    # the trends of every model and city run together
+    cdo_runner.run(cmds, limit=config["cdo_jobs"])
 
 
 def make_slope_given_var_option(path, domain, cities_lat_lon, type, var):
@@ -258,7 +258,7 @@ def pre_process(path, domain, type, cities_lat_lon, var_option):
 
     path = f"{path}/{domain}"
 
-    vars = ds_store_remover(os.listdir(path))
+    vars = catalog.list_dir(path)
 
     if var_option is None:
         for var in vars:
@@ -279,6 +279,14 @@ def main(args):
     else:
         var_option = None
 
+    if args.get('--cdo_jobs'):
+        config["cdo_jobs"] = int(args['--cdo_jobs'])
+
+    if args.get('--encoding'):
+        netcdf_encoding.policy_file = args['--encoding']
+
+    catalog.refresh(f"{path}/{domain}")
+
     if args['pre-process']:
         pre_process(path, domain, type, cities_lat_lon, var_option)
     elif args['make-table']:
@@ -0,0 +1,146 @@
+"""
+File: zarr_store.py
+Author: riley cooper
+Email: rwr.cooper@gmail.com
+Description:
+    Zarr stores of the combined rcp85 yearly cubes (1950-2100) of each model,
+    written by pre-processor.py rcp. The map layout is chunked as whole maps
+    over a few years, for reading fields such as the slope and timmean maps.
+    The series layout is the same data rechunked to the whole record over
+    small tiles of the grid, for reading the timeseries of a few grid cells
+    such as a city box. Stores are kept in store_dir next to combined_rcp85
+    and the stages of the pre-processor read from them when they exist and
+    the build manifest shows they were built from the combined file as it
+    is now, see build_manifest.py. The stores of a combined file are removed
+    when it is rebuilt.
+"""
+
+
+import os
+import shutil
+import xarray as xr
+import zarr
+import build_manifest
+import catalog
+import journal
+
+
+store_dir = "zarr_rcp85"
+
+
+# layouts of the stores
+layouts = ["map", "series"]
+
+
+# years per chunk of the map layout, grid cells per side of a series tile
+map_years = 10
+series_tile = 16
+
+
+def store_file(path_var, driving_model, rcm, type, layout):
+    '''path of the store of a model's combined file of type, layout is map or
+    series.'''
+
+    return f"{path_var}/{store_dir}/{driving_model}/{rcm}/{type}_{layout}.zarr"
+
+
+def combined_file(path_var, driving_model, rcm, type):
+    '''path of a model's combined rcp85 file of type, None if there isn't
+    one.'''
+
+    files = catalog.find(
+        f"{path_var}/combined_rcp85/{driving_model}/{rcm}", type=type)
+
+    return files[0]["path"] if files else None
+
+
+def find_store(path_var, driving_model, rcm, type, layout, combined=None):
+    '''path of a model's store of type and layout, None if there isn't one
+    up to date with its combined file, combined (looked up in the catalog if
+    not given).'''
+
+    store = store_file(path_var, driving_model, rcm, type, layout)
+
+    if not os.path.isdir(store):
+        return None
+
+    if combined is None:
+        combined = combined_file(path_var, driving_model, rcm, type)
+
+    if (combined is None or
+            not build_manifest.up_to_date(store, [combined], None)):
+        print(f"Store out of date with its combined file, not used: {store}")
+        return None
+
+    return store
+
+
+def remove_stores(path_var, driving_model, rcm, type):
+    '''removes a model's stores of type, of every layout.'''
+
+    for layout in layouts:
+        store = store_file(path_var, driving_model, rcm, type, layout)
+        if os.path.isdir(store):
+            print(f"Removing store: {store}")
+            shutil.rmtree(store)
+
+
+def compressor(spec):
+    '''zarr compressors of a spec: zstd[:level], blosc[:cname[:level]],
+    gzip[:level] or none.'''
+
+    name, *options = spec.split(":")
+
+    if name == "none":
+        return None
+    elif name == "zstd":
+        level = int(options[0]) if options else 3
+        return [zarr.codecs.ZstdCodec(level=level)]
+    elif name == "blosc":
+        cname = options[0] if options else "lz4"
+        level = int(options[1]) if len(options) > 1 else 5
+        return [zarr.codecs.BloscCodec(cname=cname, clevel=level,
+                                       shuffle="shuffle")]
+    elif name == "gzip":
+        level = int(options[0]) if options else 5
+        return [zarr.codecs.GzipCodec(level=level)]
+
+    raise ValueError(f"Unknown compressor: {spec}")
+
+
+def layout_chunks(data_array, layout):
+    '''chunks of a (time, y, x) data array for a store layout.'''
+
+    time_dim, y_dim, x_dim = data_array.dims
+
+    if layout == "map":
+        return {time_dim: map_years, y_dim: -1, x_dim: -1}
+    elif layout == "series":
+        return {time_dim: -1, y_dim: series_tile, x_dim: series_tile}
+
+    raise ValueError(f"Unknown zarr layout: {layout}")
+
+
+def write_store(data_set, var, store, layout, compressor_spec):
+    '''writes a combined data set to a store of layout. The store is written
+    under a temporary name and renamed, so readers never see a partial
+    store.'''
+
+    print(f"Writing {layout} store: {store}")
+
+    chunks = layout_chunks(data_set[var], layout)
+    data_set = data_set.drop_encoding().chunk(chunks)
+
+    encoding = {var: {"compressors": compressor(compressor_spec)}}
+
+    os.makedirs(os.path.dirname(store), exist_ok=True)
+
+    journal.atomic_write(store, lambda temp: data_set.to_zarr(
+        temp, mode="w", encoding=encoding, consolidated=False))
+
+
+def open_store(store):
+    '''opens a store lazily.'''
+
+    return xr.open_zarr(store, consolidated=False)
+